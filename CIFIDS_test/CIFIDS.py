@@ -1,12 +1,30 @@
 from DOSlib.application import Application
 from fiducials import *
+from cameraman_standin import CameraManStandIn
 from DOSlib.util import raise_error
 import sys
 class CIFIDS(Application):
-	commands = ['select_device','set_fid_on','set_fid_off','duty_cycle','get_fid_status']
+	commands = ['select_device','set_fid_on','set_fid_off','duty_cycle','get_fid_status','get_perf_stats','run_sequence','stop_sequence','get_sequence_report',
+		    'start_gating','stop_gating','get_gating_report','define_group','get_groups']
 	defaults = {'device':'PC61',
 		    'controller_type':'simulator',
 		    'service':'PetalControl',
+		    'max_workers':10,
+		    'status_ttl':1.0,
+		    'status_refresh':0.0,
+		    'rpc_timeout':10.0,
+		    'max_connections':4,
+		    'keepalive':30.0,
+		    'serializer':'',
+		    'compact_protocol':False,
+		    'exposure_frequency':0.1,
+		    'exposure_time':5.0,
+		    'exposure_notice':0.5,
+		    'gate_lead_time':0.05,
+		    'groups':{},
+		    'monitor_interval':10.0,
+		    'warm_restart':True,
+		    'state_file':'',
 		    'CanIDs' : [4840, 4841, 4842, 4843 ,4844 ,4845, 4846, 4847, 4848, 4849,4850, 4851, 4852, 4853, 4854, 4855, 4856, 4857, 4858, 4859, 4870, 4871, 4872, 4873],
 		   }
 	
@@ -18,55 +36,238 @@ class CIFIDS(Application):
 		self.device = self.config['device']
 		self.controller_type = self.config['controller_type']
 		self.service = self.config['service']
+		self.max_workers = int(self.config['max_workers'])
 		self.device_options = {'CanBus':canbus,
 					'CanIDs':self.CanIDs,
 					'Relative_Levels' : RelLevel,
 					'Default_Duty' : Duty,
+					'Groups' : dict(self.config['groups']),
+					'Status_TTL' : float(self.config['status_ttl']),
+					'Status_Refresh' : float(self.config['status_refresh']),
+					'Connection' : {'timeout' : float(self.config['rpc_timeout']),
+							'max_connections' : int(self.config['max_connections']),
+							'keepalive' : float(self.config['keepalive']),
+							'serializer' : self.config['serializer'] or None},
+					'Compact' : str(self.config['compact_protocol']).lower() in ['true', '1', 'yes'],
 					'controller': {'ip':'140.254.79.198',
                                                        'port':'33951'}
 					}
 		self.fiducials = None
+		self.sequencer = None
+		self.gate = None
+		self.exposures = None
+		self.broadcaster = StateBroadcaster()
+		self.warm_restart = str(self.config['warm_restart']).lower() in ['true', '1', 'yes']
+		self.state_file = self.config['state_file'] or STATE_SNAPSHOT
+		self.state_writer = SnapshotWriter(self.state_file, self._snapshot)
+		self.broadcaster.subscribe(self._save_state)
 		self.info('Currently no device')
 		#self.fiducials = Fiducials(controller_type = self.controller_type, service = self.service,device_options = self.device_options)
 		
 	def select_device(self, controller_name = None):
+		"""
+		Connect to one or more petal controllers
+		controller_name is a device name, a comma separated string or a list of device names
+		"""
 		if not controller_name:
 			controller_name = self.device
-		self.fiducials = Fiducials(controller_name, controller_type = self.controller_type, service = self.service,device_options = self.device_options)
-		self.info('device selected: %s', controller_name)
+		devices = device_list(controller_name)
+		if self.sequencer:
+			self.sequencer.stop()
+			self.sequencer = None
+		self.stop_gating()
+		self.broadcaster.stop_monitor()
+		if self.fiducials:
+			self.fiducials.close()
+		snapshot = None
+		if self.warm_restart:
+			saved = load_state_snapshot(self.state_file)
+			snapshot = {name : saved[name] for name in devices if name in saved}
+		self.fiducials = None
+		self.fiducials = Fiducials(devices, controller_type = self.controller_type, service = self.service,device_options = self.device_options, max_workers = self.max_workers, snapshot = snapshot)
+		self.fiducials.broadcaster = self.broadcaster
+		self.fiducials._notify()
+		if float(self.config['monitor_interval']) > 0.0:
+			self.broadcaster.start_monitor(self.fiducials, float(self.config['monitor_interval']))
+		self.info('device selected: %s' % ', '.join(devices))
 		return 'SUCCESS'
 
-	def set_fid_on(self):
+	def set_fid_on(self, force = False):
 		if not self.fiducials:
 			raise_error('no fiducials selected', level='ERROR', function = 'set_fiducials_on')
-		print(len(self.device_options['Default_Duty']))
-		self.fiducials.turn_on(level = self.device_options['Default_Duty'])		
+		# Use the controller defaults, they include set_default changes and restored defaults
+		self.fiducials.turn_on(force = force)
 		return 'SUCCESS'
 
-	def set_fid_off(self):
+	def set_fid_off(self, force = False):
 		if not self.fiducials:
 			raise_error('no fiducials selected', level='ERROR', function = 'set_fiducials_off')
-		self.fiducials.turn_off()
+		self.fiducials.turn_off(force = force)
 		return 'SUCCESS'
 
-	def duty_cycle(self, level,set_default = False):
+	def duty_cycle(self, level,set_default = False, force = False, ids = None, group = None):
+		"""
+		Set the duty cycle of the fiducials
+		ids (list of CanIDs) or group (group name) restrict the change to these fiducials,
+		level is then a scalar or a list with one value per CanID in ids/the group.
+		Only changed fiducials are sent to the petal controller, force = True resends all of them
+		"""
 		if not self.fiducials:
 			raise_error('no fiducials selected', level='ERROR', function = 'duty_cycle')
-		if not isinstance(level,list):
+		if ids is not None or group is not None:
+			self.fiducials.level(level, set_default = set_default, force = force, ids = ids, group = group)
+			if set_default:
+				self._save_state()
+			return 'SUCCESS'
+		if not isinstance(level,(list,dict)):
 			level = [level for i in range(len(self.CanIDs))]
-		self.fiducials.level(level, set_default = set_default)
+		self.fiducials.level(level, set_default = set_default, force = force)
+		if set_default:
+			self._save_state()
+		return 'SUCCESS'
+
+	def define_group(self, name, ids):
+		"""
+		Define a named group of fiducials (list of CanIDs, 'DEVICE:CanID' for a single petal controller)
+		"""
+		if self.fiducials:
+			self.fiducials.define_group(name, ids)
+		self.device_options['Groups'][name] = list(ids)
 		return 'SUCCESS'
 
-	def get_fid_status(self):
+	def get_groups(self):
+		if not self.fiducials:
+			return dict(self.device_options['Groups'])
+		return {name : group['ids'] for name, group in self.fiducials.groups.items()}
+
+	def get_fid_status(self, max_age = None):
+		"""
+		Log the fiducial status
+		The cached status is used if it is younger than max_age seconds (default: status_ttl)
+		"""
 		if not self.fiducials:
 			raise_error('no fiducials selected', level='ERROR', function = 'get_fid_status')
-		status = self.fiducials.status()
+		status = self.fiducials.status(max_age = max_age)
 		self.info("fiducials: device %s, state %s, level %s, default_duty %s" % (status['devices'], status['state'], status['level'], status['default']))
 		return 'SUCCESS' 
 
+	def get_perf_stats(self, reset = False):
+		"""
+		Returns call counts, error/reconnect counts and latency histograms of the fiducial commands
+		(fiducials.*) and of the petal controller calls (rpc.*). reset = True clears the statistics.
+		"""
+		stats = perf_stats.snapshot(reset = reset)
+		if self.fiducials:
+			stats['connections'] = self.fiducials.connection_status()
+		return stats
+
+	def run_sequence(self, steps, repeat = 1, period = None, wait = False):
+		"""
+		Run a timed duty cycle sequence (e.g. a blink pattern)
+		steps is a list of (time offset in seconds, level) pairs, level is a scalar or a per CanID list
+		With repeat > 1 the sequence restarts every period seconds.
+		wait = True returns the timing report when the sequence has finished
+		"""
+		if not self.fiducials:
+			raise_error('no fiducials selected', level='ERROR', function = 'run_sequence')
+		if not self.sequencer:
+			self.sequencer = DutySequencer(self.fiducials)
+		self.sequencer.start(steps, repeat = repeat, period = period)
+		if wait:
+			self.sequencer.wait()
+			return self.get_sequence_report()
+		return 'SUCCESS'
+
+	def stop_sequence(self):
+		if self.sequencer:
+			self.sequencer.stop()
+		return 'SUCCESS'
+
+	def get_sequence_report(self):
+		"""
+		Returns how late each step fired and how long the level command took
+		"""
+		if not self.sequencer:
+			raise_error('no sequence has been run', level='ERROR', function = 'get_sequence_report')
+		report = self.sequencer.report()
+		if report['max_lateness'] is not None:
+			self.info('sequence: %d steps fired, %d skipped, max lateness %.4f s, mean lateness %.4f s' % (len(report['steps']), report['skipped'], report['max_lateness'], report['mean_lateness']))
+		return report
+
+	def start_gating(self, level = None, lead_time = None, exposure_frequency = None, exposure_time = None, notice = None):
+		"""
+		Switch the fiducials on only while exposures are running
+		Exposure events come from a local stand-in for CAMERAMAN (exposure_frequency in Hz).
+		level is the duty used during exposures (default duty if None), lead_time the time in seconds
+		the fiducials are switched on before the exposure starts. notice is how long before the start
+		the stand-in announces an exposure.
+		"""
+		if not self.fiducials:
+			raise_error('no fiducials selected', level='ERROR', function = 'start_gating')
+		self.stop_gating()
+		self.fiducials.turn_off()
+		self.gate = ExposureGate(self.fiducials, level = level, lead_time = float(lead_time if lead_time is not None else self.config['gate_lead_time']))
+		self.exposures = CameraManStandIn(exposure_frequency = float(exposure_frequency or self.config['exposure_frequency']),
+						  exposure_time = float(exposure_time or self.config['exposure_time']),
+						  notice = float(notice if notice is not None else self.config['exposure_notice']))
+		self.exposures.subscribe(self.gate)
+		self.exposures.start()
+		self.info('gating: fiducials follow exposures, lead time %.3f s' % self.gate.lead_time)
+		return 'SUCCESS'
+
+	def stop_gating(self):
+		if self.exposures:
+			self.exposures.stop()
+			self.exposures = None
+		if self.gate:
+			self.gate.close()
+		return 'SUCCESS'
+
+	def get_gating_report(self):
+		"""
+		Returns the switching latency per exposure and whether it fits in the lead time
+		"""
+		if not self.gate:
+			raise_error('gating has not been started', level='ERROR', function = 'get_gating_report')
+		report = self.gate.report()
+		if report['max_on_latency'] is not None:
+			self.info('gating: %d exposures, %d late, max on latency %.4f s (lead time %.4f s)' % (len(report['exposures']), report['late'], report['max_on_latency'], report['lead_time']))
+		return report
+
+	def _save_state(self, event = None):
+		"""
+		Request a save of the commanded state for a warm restart (also registered as state change listener)
+		The file is written by the state writer thread, bursts of commands are coalesced
+		"""
+		if not self.warm_restart:
+			return
+		if event is not None and event['source'] != 'command':
+			return
+		self.state_writer.request()
+
+	def _snapshot(self):
+		fiducials = self.fiducials
+		return fiducials.snapshot() if fiducials is not None and self.warm_restart else None
+
+	def subscribe(self, listener = None):
+		"""
+		Register a local listener for fiducial state changes (callable or queue)
+		Without argument a new queue is returned. See StateBroadcaster for the event format.
+		"""
+		return self.broadcaster.subscribe(listener)
+
+	def unsubscribe(self, listener):
+		self.broadcaster.unsubscribe(listener)
+
 	def main(self):
-		while not self.shutdown_event.is_set():
-			time.sleep(5)
+		self.shutdown_event.wait()
+		if self.sequencer:
+			self.sequencer.stop()
+		self.stop_gating()
+		self.broadcaster.close()
+		self.state_writer.close()
+		if self.fiducials:
+			self.fiducials.close()
 		print('exiting..')
 
 if __name__ == '__main__':
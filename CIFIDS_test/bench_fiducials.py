@@ -0,0 +1,185 @@
+"""
+   Benchmarks for the fiducial command path
+   Times Fiducials.turn_on, level, status and CIFIDS.duty_cycle against the SimulatorLED and
+   against a local PetalControl stand-in (petal_standin.py), sweeping the number of CanIDs and
+   the call rate. Reports p50/p95/p99 latency and throughput and writes the results as JSON so
+   that versions can be compared (--compare).
+
+   Example:
+   python bench_fiducials.py --backends simulator,standin --canids 24,240,2400 --rates 0,50 --output bench.json
+   python bench_fiducials.py --compare bench.json --output bench_new.json
+"""
+import time, os, sys
+import json
+import math
+import argparse
+import platform
+import datetime
+import subprocess
+
+from fiducials import Fiducials
+from petal_standin import start_standin
+from CIFIDS import CIFIDS
+
+PATHS = ['turn_on', 'level', 'level_unchanged', 'status', 'duty_cycle']
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of a sorted list
+    """
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1))
+    return values[k]
+
+def summarize(latencies, elapsed, errors):
+    values = sorted(latencies)
+    return {'calls' : len(values),
+            'errors' : errors,
+            'p50' : percentile(values, 50),
+            'p95' : percentile(values, 95),
+            'p99' : percentile(values, 99),
+            'mean' : sum(values) / len(values) if values else None,
+            'max' : values[-1] if values else None,
+            'throughput' : len(values) / elapsed if elapsed > 0 else None}
+
+def cifids_app(fiducials, can_ids):
+    """
+    CIFIDS instance wired to fiducials without running the DOS application framework
+    """
+    app = CIFIDS.__new__(CIFIDS)
+    app.CanIDs = can_ids
+    app.fiducials = fiducials
+    return app
+
+def make_fiducials(backend, can_ids, args):
+    """
+    Returns (fiducials, daemon). daemon is the stand-in Pyro daemon (None for the simulator)
+    """
+    options = {'CanIDs' : can_ids,
+               'CanBus' : ['can0' for i in range(len(can_ids))],
+               'Relative_Levels' : [1.0 for i in range(len(can_ids))],
+               'Default_Duty' : [50.0 for i in range(len(can_ids))],
+               'Status_TTL' : args.status_ttl,
+               'Compact' : args.compact}
+    daemon = None
+    if backend == 'simulator':
+        controller_type = 'simulator'
+    elif backend == 'standin':
+        controller_type = 'fiposled'
+        daemon, options['controller'] = start_standin(args.device, can_ids = can_ids, latency = args.latency, serializers = ['serpent', 'marshal', 'json', 'pickle'])
+        options['Connection'] = {'timeout' : 10.0, 'keepalive' : 0.0, 'serializer' : args.serializer}
+    else:
+        raise ValueError('Unknown backend %s' % backend)
+    return Fiducials(args.device, controller_type = controller_type, device_options = options), daemon
+
+def run_path(path, fiducials, app, can_ids, calls, rate):
+    """
+    Time calls invocations of path. rate is the target call rate in Hz (0: back to back)
+    With a rate, latencies are measured from the scheduled call time so that queueing delay
+    is included when calls fall behind. The turn_off preparing each turn_on is not counted.
+    """
+    n = len(can_ids)
+    duty = [[10.0 + (i % 7) for i in range(n)], [20.0 + (i % 5) for i in range(n)]]
+    fiducials.level(duty[1])
+    latencies = []
+    errors = 0
+    excluded = 0.0
+    start = time.perf_counter()
+    for k in range(calls):
+        if path == 'turn_on':
+            t = time.perf_counter()
+            fiducials.turn_off()
+            excluded += time.perf_counter() - t
+        t0 = time.perf_counter()
+        if rate > 0:
+            scheduled = start + excluded + k / float(rate)
+            if scheduled > t0:
+                time.sleep(scheduled - t0)
+            t0 = scheduled
+        try:
+            if path == 'turn_on':
+                fiducials.turn_on()
+            elif path == 'level':
+                fiducials.level(duty[k % 2])
+            elif path == 'level_unchanged':
+                fiducials.level(duty[1])
+            elif path == 'status':
+                fiducials.status()
+            elif path == 'duty_cycle':
+                app.duty_cycle(duty[k % 2])
+        except Exception as e:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - start - excluded, errors)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def compare(results, baseline_file):
+    """
+    Print the p50/p99 ratios with respect to a previous result file
+    """
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    key = lambda r : (r['backend'], r['path'], r['canids'], r['rate'])
+    old = {key(r) : r for r in baseline['results']}
+    print('\nComparison with %s (revision %s): new/old' % (baseline_file, baseline['meta'].get('revision')))
+    for r in results:
+        if key(r) not in old or not old[key(r)]['p50'] or not r['p50']:
+            continue
+        o = old[key(r)]
+        print('%-10s %-16s %6d %6s  p50 %6.2f  p99 %6.2f' % (r['backend'], r['path'], r['canids'], r['rate'], r['p50'] / o['p50'], r['p99'] / o['p99']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the fiducial command path')
+    parser.add_argument('--backends', default = 'simulator,standin')
+    parser.add_argument('--paths', default = ','.join(PATHS))
+    parser.add_argument('--canids', default = '24,96,480,2400', help = 'number of CanIDs to sweep')
+    parser.add_argument('--rates', default = '0', help = 'call rates (Hz) to sweep, 0 = back to back')
+    parser.add_argument('--calls', type = int, default = 200, help = 'calls per measurement')
+    parser.add_argument('--latency', default = None, help = 'stand-in latency specification (see petal_standin.py)')
+    parser.add_argument('--status_ttl', type = float, default = 0.0)
+    parser.add_argument('--compact', action = 'store_true', help = 'use the compact session protocol')
+    parser.add_argument('--serializer', default = None, help = 'Pyro serializer for the stand-in backend')
+    parser.add_argument('--device', default = 'PC61')
+    parser.add_argument('--output', default = None, help = 'JSON result file')
+    parser.add_argument('--compare', default = None, help = 'previous JSON result file')
+    args = parser.parse_args()
+
+    results = []
+    print('%-10s %-16s %6s %6s %10s %10s %10s %10s %6s' % ('backend', 'path', 'canids', 'rate', 'p50 [ms]', 'p95 [ms]', 'p99 [ms]', 'calls/s', 'errors'))
+    for backend in args.backends.split(','):
+        for n in [int(v) for v in args.canids.split(',')]:
+            can_ids = list(range(1000, 1000 + n))
+            fiducials, daemon = make_fiducials(backend, can_ids, args)
+            app = cifids_app(fiducials, can_ids)
+            try:
+                for rate in [float(v) for v in args.rates.split(',')]:
+                    for path in args.paths.split(','):
+                        r = run_path(path, fiducials, app, can_ids, args.calls, rate)
+                        r.update({'backend' : backend, 'path' : path, 'canids' : n, 'rate' : rate})
+                        results.append(r)
+                        ms = lambda v : 1000.0 * v if v is not None else float('nan')
+                        print('%-10s %-16s %6d %6s %10.3f %10.3f %10.3f %10.1f %6d' % (backend, path, n, rate, ms(r['p50']), ms(r['p95']), ms(r['p99']), r['throughput'] or 0.0, r['errors']))
+            finally:
+                fiducials.close()
+                if daemon is not None:
+                    daemon.shutdown()
+
+    if args.output:
+        meta = {'revision' : git_revision(),
+                'date' : datetime.datetime.utcnow().isoformat(),
+                'python' : platform.python_version(),
+                'host' : platform.node(),
+                'arguments' : vars(args)}
+        with open(args.output, 'w') as f:
+            json.dump({'meta' : meta, 'results' : results}, f, indent=2)
+        print('Results written to %s' % args.output)
+    if args.compare:
+        compare(results, args.compare)
+    sys.exit()
@@ -0,0 +1,73 @@
+"""
+   Local stand-in for the CAMERAMAN exposure sequence
+   Generates exposures at exposure_frequency (Hz, as in the CAMERAMAN role of total_test.ini)
+   and publishes their events to subscribed callbacks:
+        callback('exposure_pending', expid, start)   notice seconds before the exposure starts
+        callback('exposure_start', expid, t)
+        callback('exposure_stop', expid, t)
+   All times are time.monotonic() values. Callbacks run in the stand-in thread and must not block.
+"""
+import time
+import threading
+
+class CameraManStandIn(object):
+    def __init__(self, exposure_frequency = 0.1, exposure_time = 5.0, notice = 0.5):
+        self.period = 1.0 / float(exposure_frequency)
+        self.exposure_time = float(exposure_time)
+        self.notice = float(notice)
+        if self.exposure_time + self.notice >= self.period:
+            raise ValueError('exposure time plus notice must be shorter than 1/exposure_frequency')
+        self.subscribers = []
+        self.expid = 0
+        self.thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        with self._lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def publish(self, event, expid, t):
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(event, expid, t)
+            except Exception as e:
+                print('cameraman_standin: subscriber failed for %s: %s' % (event, str(e)))
+
+    def start(self):
+        self.stop()
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self._stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        next_start = time.monotonic() + self.notice
+        while True:
+            self.expid += 1
+            expid = self.expid
+            # Announce the exposure
+            if self._stop.wait(max(0.0, next_start - self.notice - time.monotonic())):
+                return
+            self.publish('exposure_pending', expid, next_start)
+            if self._stop.wait(max(0.0, next_start - time.monotonic())):
+                return
+            self.publish('exposure_start', expid, time.monotonic())
+            if self._stop.wait(max(0.0, next_start + self.exposure_time - time.monotonic())):
+                self.publish('exposure_stop', expid, time.monotonic())
+                return
+            self.publish('exposure_stop', expid, time.monotonic())
+            next_start += self.period
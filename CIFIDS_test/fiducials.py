@@ -9,7 +9,18 @@
 """
 import time, os, sys, re
 import threading
+import collections
+import json
+import random
+import concurrent.futures
+import asyncio
+import functools
+import contextlib
+import bisect
+import queue
 import Pyro4
+import serpent
+import numpy as np
 import datetime
 
 import DOSlib.logger as Log
@@ -17,20 +28,109 @@ from DOSlib.PML import SUCCESS, FAILED
 from DOSlib.advertise import Seeker
 from DOSlib.util import raise_error
 
+######################################
+#
+# Performance statistics
+#
+######################################
+class PerfStats(object):
+    """
+    Thread safe call counters and latency histograms keyed by command name
+    BUCKETS are the upper bounds (seconds) of the histogram bins, the last bin is open ended
+    """
+    BUCKETS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+            self.since = time.time()
+
+    def _entry(self, name):
+        if name not in self.commands:
+            self.commands[name] = {'calls' : 0, 'errors' : 0, 'reconnects' : 0, 'timeouts' : 0, 'rejected' : 0,
+                                   'total' : 0.0, 'min' : None, 'max' : None,
+                                   'histogram' : [0 for i in range(len(self.BUCKETS) + 1)]}
+        return self.commands[name]
+
+    def record(self, name, elapsed, error = False):
+        with self.lock:
+            entry = self._entry(name)
+            entry['calls'] += 1
+            if error:
+                entry['errors'] += 1
+            entry['total'] += elapsed
+            entry['min'] = elapsed if entry['min'] is None else min(entry['min'], elapsed)
+            entry['max'] = elapsed if entry['max'] is None else max(entry['max'], elapsed)
+            entry['histogram'][bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+
+    def count(self, name, counter, n = 1):
+        with self.lock:
+            self._entry(name)[counter] += n
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.record(name, time.perf_counter() - start, error = True)
+            raise
+        self.record(name, time.perf_counter() - start)
+
+    def _percentile(self, histogram, calls, p):
+        """
+        Upper bound of the histogram bin containing the p-th percentile (None: above the last bound)
+        """
+        target = p / 100.0 * calls
+        total = 0
+        for i, n in enumerate(histogram):
+            total += n
+            if total >= target and n > 0:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else None
+        return None
+
+    def snapshot(self, reset = False):
+        """
+        Returns the statistics as a dictionary {command : statistics}
+        """
+        with self.lock:
+            commands = self.commands
+            since = self.since
+            if reset:
+                self.commands = {}
+                self.since = time.time()
+        labels = ['<=%gms' % (1000.0 * b) for b in self.BUCKETS] + ['>%gms' % (1000.0 * self.BUCKETS[-1])]
+        result = {}
+        for name, entry in commands.items():
+            stats = {key : entry[key] for key in ['calls', 'errors', 'reconnects', 'timeouts', 'rejected', 'min', 'max']}
+            timed = sum(entry['histogram'])
+            stats['mean'] = entry['total'] / timed if timed else None
+            for p in [50, 95, 99]:
+                stats['p%d' % p] = self._percentile(entry['histogram'], timed, p)
+            stats['histogram'] = {label : n for label, n in zip(labels, entry['histogram']) if n > 0}
+            result[name] = stats
+        return {'since' : datetime.datetime.utcfromtimestamp(since).isoformat(), 'commands' : result}
+
+# Shared by all fiducial objects in the process
+perf_stats = PerfStats()
+
 class Fiducials():
-    def __init__(self, device, controller_type = 'simulator', service = 'PetalControl', device_options = {}):
+    def __init__(self, device, controller_type = 'simulator', service = 'PetalControl', device_options = {}, max_workers = 10, snapshot = None):
         """
         Initialize fiducials class
-        device is the DOS device name of the BBB controller
+        device is the DOS device name of the BBB controller. A list (or comma separated string)
+        of device names drives several petal controllers at once.
         service is the name of the DOS advertiser service used
         device_options configure the fipos controller (CanBus, CanIDs, Relative_Levels, Default_Duty)
+        Per controller settings can be given as device_options[<device name>] = {...}
+        max_workers is the size of the worker pool shared by all callers for commands to several
+        petal controllers (the first controller of each command is called on the caller's thread)
+        snapshot is a state snapshot (see snapshot()) to restore instead of turning the fiducials off
         """
-        # Defaults
-        CanIDs = [784, 1475]
-        CanBus = ['can0' for i in range(len(CanIDs))]
-        RelLevel = [1.0 for i in range(len(CanIDs))] 
-        Duty = [5.0 for i in range(len(CanIDs))] 
-
         # Log functions
         for level in ['msg', 'debug', 'info', 'warn', 'error']:
             if hasattr(Log, level):
@@ -38,15 +138,82 @@ class Fiducials():
 
         # default settings
         self.hardware = 'fiposled' if str(controller_type).lower() in ['hardware', 'fiposled', 'bbb'] else str(controller_type).lower()
-        self.petal_controller = device
-        config = {'service' : service,
-                  'CanBus' : device_options.get('CanBus', CanBus),
-                  'CanIDs' : device_options.get('CanIDs', CanIDs),
-                  'Relative_Levels' : device_options.get('Relative_Levels', RelLevel),
-                  'Default_Duty' : device_options.get('Default_Duty', Duty),
-                  'controller': device_options.get('controller','')}
-
-        self.info('fiducials: device %s, controller %s, Config: %r' % (self.petal_controller, self.hardware, config))
+        self.petal_controllers = device_list(device)
+        if len(self.petal_controllers) == 0:
+            raise_error('fiducials: No petal controller specified', level='ERROR', function='init')
+        self.petal_controller = ', '.join(self.petal_controllers)
+        self.service = service
+        self.device_options = device_options
+
+        # Worker pool used to fan commands out to the petal controllers. It is shared by all
+        # calling threads, so it is not limited to the number of controllers.
+        self._pool = None
+        if len(self.petal_controllers) > 1:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers = max(1, int(max_workers)))
+
+        # Connect to the controllers
+        self.controller = None
+        self.controllers = {}
+        results = self._fan_out('_connect', {name : (name,) for name in self.petal_controllers}, target = self)
+        for name in self.petal_controllers:
+            self.controllers[name] = results[name]
+        self.controller = self.controllers[self.petal_controllers[0]]
+
+        # CanID -> index maps and named groups of fiducials
+        self._index = {name : {id : i for i, id in enumerate(self.controllers[name].CanIDs)} for name in self.petal_controllers}
+        self.broadcaster = None
+        self.groups = {}
+        self.define_group('all', [])
+        for name in self.petal_controllers:
+            self.define_group(name, ['%s:%s' % (name, id) for id in self.controllers[name].CanIDs])
+        for name, ids in device_options.get('Groups', {}).items():
+            # Configured groups may refer to controllers that are not selected
+            try:
+                self.define_group(name, ids)
+            except Exception as e:
+                self.warn('fiducials: Group %s skipped: %s' % (name, str(e)))
+
+        try:
+            if snapshot:
+                # Warm restart
+                self.info('fiducials: Restored state for %r' % self.restore(snapshot))
+                return
+
+            # Turn fiducials off
+            self.info('fiducials: Turning fiducials off')
+            self._fan_out('turn_off')
+            
+            # get status
+            self.info('fiducials: device status: %r' % self.status())
+        except Exception:
+            self.close()
+            raise
+
+    def _connect(self, device):
+        """
+        Create the LED controller object for a single petal controller
+        """
+        # Defaults
+        CanIDs = [784, 1475]
+        CanBus = ['can0' for i in range(len(CanIDs))]
+        RelLevel = [1.0 for i in range(len(CanIDs))] 
+        Duty = [5.0 for i in range(len(CanIDs))] 
+
+        options = dict(self.device_options)
+        if isinstance(self.device_options.get(device), dict):
+            options.update(self.device_options[device])
+        config = {'service' : self.service,
+                  'CanBus' : options.get('CanBus', CanBus),
+                  'CanIDs' : options.get('CanIDs', CanIDs),
+                  'Relative_Levels' : options.get('Relative_Levels', RelLevel),
+                  'Default_Duty' : options.get('Default_Duty', Duty),
+                  'Status_TTL' : options.get('Status_TTL', 0.0),
+                  'Status_Refresh' : options.get('Status_Refresh', 0.0),
+                  'Connection' : options.get('Connection', {}),
+                  'Compact' : options.get('Compact', False),
+                  'controller': options.get('controller','')}
+
+        self.info('fiducials: device %s, controller %s, Config: %r' % (device, self.hardware, config))
         
         # Connect to the controller
         print('89753 config')
@@ -54,43 +221,669 @@ class Fiducials():
         print('89754 config')
         try:
             if str(self.hardware).lower() == 'simulator':
-                self.controller = SimulatorLED(self.petal_controller,config)
+                return SimulatorLED(device,config)
             elif str(self.hardware).lower() == 'fiposled':
-                self.controller = FiposLED(self.petal_controller, config)
+                return FiposLED(device, config)
             else:
                 raise_error('fiducials: Invalid controller_type', level='ERROR', function='init')
         except Exception as e:
-            raise_error('fiducials: Exception connecting to LED controller: %s' % str(e), level='ERROR', function='init')
+            raise_error('fiducials: Exception connecting to LED controller %s: %s' % (device, str(e)), level='ERROR', function='init')
 
-        # Turn fiducials off
-        self.info('fiducials: Turning fiducials off')
-        self.controller.turn_off()
-        
-        # get status
-        self.info('fiducials: device status: %r' % self.controller.status())
-        
-    def status(self):
+    def _restore_device(self, device, entry):
+        """
+        Restore the snapshot entry of a single petal controller, returns False if the entry does not match
+        """
+        controller = self.controllers[device]
+        if not isinstance(entry, dict) or list(entry.get('CanIDs', [])) != list(controller.CanIDs):
+            self.warn('fiducials: No matching snapshot for %s, turning fiducials off' % device)
+            controller.turn_off()
+            return False
+        if entry.get('default') is not None:
+            controller.Default_Duty = list(entry['default'])
+            controller.controller['default'] = controller.Default_Duty
+        force = False
+        try:
+            controller.status(max_age = 0)
+        except Exception as e:
+            self.warn('fiducials: Cannot read status of %s, resending the snapshot: %s' % (device, str(e)))
+            force = True
+        level = entry.get('level', [])
+        indices = [i for i, value in enumerate(level) if value is not None]
+        if indices:
+            controller.level([float(level[i]) for i in indices], force = force, indices = indices)
+        return True
+
+    def _fan_out(self, function, per_device = None, target = None, **kwargs):
+        """
+        Call function on the petal controllers (concurrently if there is more than one)
+        per_device maps device names to the positional arguments for that controller. If given,
+        only these controllers are called.
+        target is the object providing function (default: the LED controller of each device)
+        Returns a dictionary {device : result}
+        """
+        names = list(per_device.keys()) if per_device is not None else list(self.controllers.keys())
+        def call(name):
+            obj = target if target is not None else self.controllers[name]
+            args = per_device[name] if per_device is not None else ()
+            return getattr(obj, function)(*args, **kwargs)
+        if self._pool is None or len(names) == 1:
+            return {name : call(name) for name in names}
+        # The first controller is called on the caller's thread
+        futures = {name : self._pool.submit(call, name) for name in names[1:]}
+        results = {}
+        failed = []
+        for name in names:
+            try:
+                results[name] = futures[name].result() if name in futures else call(name)
+            except Exception as e:
+                failed.append('%s (%s)' % (name, str(e)))
+        if failed:
+            raise_error('fiducials: %s failed for %s' % (function.strip('_'), ', '.join(failed)), level='ERROR', function=function)
+        return results
+
+    def _split_level(self, level):
+        """
+        Distribute level over the petal controllers
+        level can be a scalar (all fiducials), a dictionary keyed by device name, a list covering
+        all fiducials of all controllers (in device order) or a list that is applied to every controller
+        """
+        if isinstance(level, dict):
+            unknown = [name for name in level if name not in self.controllers]
+            if unknown:
+                raise_error('fiducials: Unknown petal controller(s) %r' % unknown, level='ERROR', function='level')
+            return {name : (value,) for name, value in level.items()}
+        if not isinstance(level, list) or len(self.controllers) == 1:
+            return {name : (level,) for name in self.controllers}
+        sizes = [len(self.controllers[name].CanIDs) for name in self.controllers]
+        if len(level) == sum(sizes):
+            per_device = {}
+            start = 0
+            for name, size in zip(self.controllers, sizes):
+                per_device[name] = (level[start:start+size],)
+                start += size
+            return per_device
+        if all(size == len(level) for size in sizes):
+            return {name : (list(level),) for name in self.controllers}
+        raise_error('fiducials: Incorrect list length %d for %d fiducials' % (len(level), sum(sizes)), level='ERROR', function='level')
+
+    def keys(self):
+        """
+        (device, CanID) pairs of all fiducials in the order used by status()
+        """
+        return [(name, id) for name in self.petal_controllers for id in self.controllers[name].CanIDs]
+
+    def commanded(self):
+        """
+        Returns the commanded level of all fiducials (None if unknown), in the order used by status()
+        """
+        return [value for name in self.petal_controllers for value in self.controllers[name].commanded()]
+
+    def snapshot(self):
+        """
+        Returns the commanded levels and default duties per petal controller
+        """
+        return {name : {'CanIDs' : list(self.controllers[name].CanIDs),
+                        'level' : self.controllers[name].commanded(),
+                        'default' : duty_vector(self.controllers[name].controller['default'], len(self.controllers[name].CanIDs)).tolist()}
+                for name in self.petal_controllers}
+
+    def restore(self, snapshot):
+        """
+        Restore a snapshot without turning the fiducials off
+        The status of each petal controller is read once and only the fiducials whose level differs
+        from the snapshot are commanded. Controllers without a matching entry (same CanIDs) are turned off.
+        Returns the list of restored controllers
+        """
+        results = self._fan_out('_restore_device', {name : (name, snapshot.get(name)) for name in self.petal_controllers}, target = self)
+        self._notify()
+        return [name for name in self.petal_controllers if results[name]]
+
+    def _notify(self, names = None):
+        """
+        Publish the commanded state of the controllers in names (default: all)
+        No petal controller call or controller lock is involved
+        """
+        if self.broadcaster is None:
+            return
+        keys, state, level = self.commanded_state(names)
+        self.broadcaster.publish(keys, state, level, 'command')
+
+    def commanded_state(self, names = None):
+        """
+        Returns keys, state and level of the fiducials of the controllers in names (default: all)
+        Levels are the commanded duties (0.0 if unknown)
+        """
+        names = self.petal_controllers if names is None else [name for name in self.petal_controllers if name in names]
+        keys = [(name, id) for name in names for id in self.controllers[name].CanIDs]
+        level = [value for name in names for value in self.controllers[name].commanded()]
+        state = ['unknown' if v is None else ('on' if v > 0.0 else 'off') for v in level]
+        return keys, state, [0.0 if v is None else v for v in level]
+
+    def define_group(self, name, ids):
+        """
+        Define a named group of fiducials. ids is a list of CanIDs; a CanID applies to every
+        petal controller that has it, 'DEVICE:CanID' selects a single controller.
+        The group 'all' and one group per petal controller are predefined.
+        """
+        if name == 'all':
+            self.groups[name] = {'ids' : [], 'targets' : None}
+        else:
+            self.groups[name] = {'ids' : list(ids), 'targets' : self._resolve(ids)}
+        return self.groups[name]
+
+    def _resolve(self, ids):
+        """
+        Map a list of CanIDs to {device : (indices, positions)}
+        indices are positions in the CanIDs of the controller, positions index into ids
+        """
+        targets = {}
+        for position, entry in enumerate(ids):
+            device, _, canid = str(entry).rpartition(':')
+            try:
+                canid = int(canid)
+            except ValueError:
+                raise_error('fiducials: Invalid CanID %r' % entry, level='ERROR', function='resolve')
+            if device and device not in self._index:
+                raise_error('fiducials: Unknown petal controller %r' % device, level='ERROR', function='resolve')
+            found = False
+            for name in ([device] if device else self.petal_controllers):
+                if canid in self._index[name]:
+                    indices, positions = targets.setdefault(name, ([], []))
+                    indices.append(self._index[name][canid])
+                    positions.append(position)
+                    found = True
+            if not found:
+                raise_error('fiducials: Unknown CanID %r' % entry, level='ERROR', function='resolve')
+        return {name : (np.asarray(indices, dtype=int), np.asarray(positions, dtype=int)) for name, (indices, positions) in targets.items()}
+
+    def _split_subset(self, level, targets, size, set_default, force):
+        """
+        Per controller arguments for level() on a resolved subset
+        level is a scalar or a list with one value per entry of the id list (size entries)
+        """
+        if isinstance(level, (list, tuple, np.ndarray)):
+            if len(level) != size:
+                raise_error('fiducials: Incorrect list length %d for %d fiducials' % (len(level), size), level='ERROR', function='level')
+            values = np.asarray(level, dtype=float)
+            return {name : (values[positions], set_default, force, indices) for name, (indices, positions) in targets.items()}
+        return {name : (level, set_default, force, indices) for name, (indices, positions) in targets.items()}
+
+    def prepare(self, level):
+        """
+        Validate level and split it per controller ahead of time (see apply)
+        """
+        return {name : (duty_vector(args[0], len(self.controllers[name].CanIDs)).tolist(),) for name, args in self._split_level(level).items()}
+
+    def apply(self, prepared, force = False):
+        """
+        Set a level returned by prepare
+        """
+        if not self.controller:
+            raise_error('No LED controller connected', level='WARN', function='apply')
+        try:
+            with perf_stats.timer('fiducials.apply'):
+                self._fan_out('level', prepared, force = force)
+        finally:
+            self._notify(prepared)
+
+    def connection_status(self):
+        """
+        Returns the connection health of every petal controller (None for simulators)
+        """
+        return {name : controller.pcomm.connection_status() if getattr(controller, 'pcomm', None) else None for name, controller in self.controllers.items()}
+
+    def close(self):
+        """
+        Stop the status refreshers and release the worker pool
+        """
+        for controller in self.controllers.values():
+            if hasattr(controller, 'close'):
+                controller.close()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def status(self, max_age = None):
         if not self.controller:
             raise_error('No LED controller connected', level='WARN', function = 'status')
-        return self.controller.status()
+        with perf_stats.timer('fiducials.status'):
+            results = self._fan_out('status', max_age = max_age)
+        if len(results) == 1:
+            return results[self.petal_controllers[0]]
+        # Merge the per controller results (in device order)
+        merged = {'devices' : [], 'state' : [], 'level' : [], 'default' : [], 'controllers' : results}
+        for name in self.petal_controllers:
+            status = results[name]
+            for key in ['devices', 'state', 'level', 'default']:
+                value = status[key]
+                merged[key].extend(list(value) if isinstance(value, list) else [value for i in range(len(status['devices']))])
+        return merged
     
-    def turn_on(self, level = None):
+    def turn_on(self, level = None, force = False):
         if not self.controller:
             raise_error('No LED controller connected', level='WARN', function='turn_on')
         self.info('turn_on: turning fiducials on')
-        self.controller.turn_on(level = level)
+        targets = None
+        try:
+            with perf_stats.timer('fiducials.turn_on'):
+                if level is None:
+                    self._fan_out('turn_on', force = force)
+                else:
+                    targets = self._split_level(level)
+                    self._fan_out('turn_on', targets, force = force)
+        finally:
+            self._notify(targets)
 
-    def turn_off(self):
+    def turn_off(self, force = False):
         if not self.controller:
             raise_error('No LED controller connected', level='WARN', function='turn_off')
         self.info('turn_off: turning fiducials off')
-        self.controller.turn_off()
+        try:
+            with perf_stats.timer('fiducials.turn_off'):
+                self._fan_out('turn_off', force = force)
+        finally:
+            self._notify()
 
-    def level(self, level, set_default = False):
+    def level(self, level, set_default = False, force = False, ids = None, group = None):
+        """
+        Set the level of all fiducials, of the CanIDs in ids or of a named group
+        """
         if not self.controller:
             raise_error('No LED controller connected', level='WARN', function='level')
-        self.info('level: setting level to %r (set_default = %r)' % (level, set_default))
-        self.controller.level(level, set_default = set_default)
+        self.info('level: setting level to %r (set_default = %r, force = %r, ids = %r, group = %r)' % (level, set_default, force, ids, group))
+        if group is not None and group not in self.groups:
+            raise_error('fiducials: Unknown group %r' % group, level='ERROR', function='level')
+        targets = {}
+        try:
+            with perf_stats.timer('fiducials.level'):
+                if ids is not None:
+                    targets = self._split_subset(level, self._resolve(ids), len(ids), set_default, force)
+                    self._fan_out('level', targets)
+                elif group is not None and self.groups[group]['targets'] is not None:
+                    targets = self._split_subset(level, self.groups[group]['targets'], len(self.groups[group]['ids']), set_default, force)
+                    self._fan_out('level', targets)
+                else:
+                    targets = self._split_level(level)
+                    self._fan_out('level', targets, set_default = set_default, force = force)
+        finally:
+            self._notify(targets)
+
+class StateBroadcaster(object):
+    """
+    Publishes fiducial state changes to local listeners
+    A listener is a callable, called as listener(event), or a queue that receives the events.
+    Events are delivered from a dispatcher thread so that slow listeners never delay commands:
+        {'time' : unix time, 'source' : 'command' or 'monitor',
+         'changes' : [{'device', 'id', 'state', 'level', 'previous_state', 'previous_level'}, ...]}
+    Only fiducials whose state or level differs from the last published values are reported.
+    """
+    def __init__(self):
+        self.listeners = []
+        self.last = {}           # (device, CanID) -> (state, level)
+        self._lock = threading.Lock()
+        self._events = queue.Queue()
+        self._stop = threading.Event()
+        self.monitor_thread = None
+        self.dispatch_thread = threading.Thread(target=self._dispatch)
+        self.dispatch_thread.setDaemon(True)
+        self.dispatch_thread.start()
+
+    def subscribe(self, listener = None):
+        """
+        Register a listener. Without argument a new queue is created. Returns the listener.
+        """
+        if listener is None:
+            listener = queue.Queue()
+        with self._lock:
+            self.listeners.append(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def publish(self, devices, state, level, source, tolerance = 0.0):
+        """
+        devices is a list of (device, CanID) pairs, state and level the corresponding values
+        Level differences below tolerance are not reported
+        """
+        changes = []
+        with self._lock:
+            for key, s, l in zip(devices, state, level):
+                previous = self.last.get(key)
+                if previous is None or previous[0] != s or abs(previous[1] - l) > tolerance:
+                    changes.append({'device' : key[0], 'id' : key[1], 'state' : s, 'level' : l,
+                                    'previous_state' : previous[0] if previous else None,
+                                    'previous_level' : previous[1] if previous else None})
+                    self.last[key] = (s, l)
+        if changes:
+            self._events.put({'time' : time.time(), 'source' : source, 'changes' : changes})
+
+    def _dispatch(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            with self._lock:
+                listeners = list(self.listeners)
+            for listener in listeners:
+                try:
+                    if hasattr(listener, 'put'):
+                        listener.put(event)
+                    else:
+                        listener(event)
+                except Exception as e:
+                    if hasattr(Log, 'warn'):
+                        Log.warn('StateBroadcaster: listener failed: %s' % str(e))
+
+    def start_monitor(self, fiducials, interval):
+        """
+        Compare the controller status with the published state every interval seconds
+        """
+        self.stop_monitor()
+        self._stop.clear()
+        self.monitor_thread = threading.Thread(target=self._monitor, args=(fiducials, float(interval)))
+        self.monitor_thread.setDaemon(True)
+        self.monitor_thread.start()
+
+    def stop_monitor(self):
+        if self.monitor_thread is not None:
+            self._stop.set()
+            self.monitor_thread.join()
+            self.monitor_thread = None
+
+    def _monitor(self, fiducials, interval):
+        while not self._stop.wait(interval):
+            try:
+                fiducials.status()
+            except Exception as e:
+                continue
+            # status() refreshes the commanded duties from the readback. Publish these rather than
+            # status['level'] (scaled by Relative_Levels) so monitor and command events match.
+            keys, state, level = fiducials.commanded_state()
+            self.publish(keys, state, level, 'monitor', tolerance = 1.0)
+
+    def close(self):
+        self.stop_monitor()
+        self._events.put(None)
+        self.dispatch_thread.join()
+
+class DutySequencer(object):
+    """
+    Runs a timed sequence of duty settings (flicker, ramp and blink patterns) on a Fiducials object
+    steps is a list of (time offset in seconds, level) pairs, level is anything Fiducials.level accepts.
+    Steps fire on the monotonic clock: the thread sleeps until spin seconds before the target time
+    and busy-waits for the rest. Steps with the same level as the previous step are skipped.
+    If a step fires late (e.g. the previous command took longer than the step interval) the
+    following steps are fired as soon as possible.
+    """
+    def __init__(self, fiducials, spin = 0.002):
+        self.fiducials = fiducials
+        self.spin = spin
+        self.thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._report = {'running' : False, 'steps' : []}
+
+    def start(self, steps, repeat = 1, period = None):
+        """
+        Start the sequence. With repeat > 1 the sequence restarts every period seconds.
+        """
+        steps = sorted([(float(offset), level) for offset, level in steps], key = lambda step : step[0])
+        if len(steps) == 0:
+            raise_error('sequence: no steps', level='ERROR', function='start')
+        if steps[0][0] < 0.0:
+            raise_error('sequence: negative time offset', level='ERROR', function='start')
+        if int(repeat) > 1 and (period is None or float(period) <= steps[-1][0]):
+            raise_error('sequence: period must be longer than the last time offset', level='ERROR', function='start')
+        self.stop()
+        self._stop.clear()
+        with self._lock:
+            self._report = {'running' : True, 'steps' : [], 'skipped' : 0, 'errors' : 0}
+        self.thread = threading.Thread(target=self._run, args=(steps, int(repeat), float(period or 0.0)))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self._stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def wait(self, timeout = None):
+        """
+        Wait for the sequence to finish. Returns True if it has finished.
+        """
+        if self.thread is not None:
+            self.thread.join(timeout)
+            return not self.thread.is_alive()
+        return True
+
+    def report(self):
+        """
+        Returns the step timing: lateness is the delay between the target time and the moment the
+        step fired, duration the time the level command took (seconds)
+        """
+        with self._lock:
+            report = dict(self._report)
+            report['steps'] = list(self._report['steps'])
+        fired = [step['lateness'] for step in report['steps']]
+        report['max_lateness'] = max(fired) if fired else None
+        report['mean_lateness'] = sum(fired) / len(fired) if fired else None
+        return report
+
+    def _run(self, steps, repeat, period):
+        start = time.monotonic()
+        previous = None
+        try:
+            for cycle in range(repeat):
+                for index, (offset, level) in enumerate(steps):
+                    target = start + cycle * period + offset
+                    if not wait_until(target, self._stop, self.spin):
+                        return
+                    if previous is not None and level == previous:
+                        with self._lock:
+                            self._report['skipped'] += 1
+                        continue
+                    fired = time.monotonic()
+                    error = None
+                    try:
+                        self.fiducials.level(level)
+                        previous = level
+                    except Exception as e:
+                        error = str(e)
+                        previous = None
+                    with self._lock:
+                        self._report['steps'].append({'cycle' : cycle, 'index' : index, 'offset' : offset,
+                                                      'lateness' : fired - target, 'duration' : time.monotonic() - fired,
+                                                      'error' : error})
+                        if error:
+                            self._report['errors'] += 1
+        finally:
+            with self._lock:
+                self._report['running'] = False
+                self._report['elapsed'] = time.monotonic() - start
+
+class ExposureGate(object):
+    """
+    Keeps the fiducials on only while exposures are running
+    Subscribe the gate to exposure events (see cameraman_standin.py); it is called as
+    gate(event, expid, t) with t on the time.monotonic() clock:
+        exposure_pending    t is the announced start time, fiducials are switched on lead_time seconds before it
+        exposure_start      the integration started
+        exposure_stop       the integration ended, fiducials are switched off
+    The target duty vector is validated and split per controller when the gate is armed.
+    report() compares the measured switching latency with the lead time.
+    """
+    def __init__(self, fiducials, level = None, lead_time = 0.05, spin = 0.002):
+        self.fiducials = fiducials
+        self.lead_time = float(lead_time)
+        self.spin = spin
+        self.exposures = {}
+        self._actions = queue.Queue()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.arm(level)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def arm(self, level = None):
+        """
+        Set the duty vector used during exposures (None: default duty)
+        """
+        self.prepared = None if level is None else self.fiducials.prepare(level)
+
+    def close(self):
+        """
+        Stop the gate and switch the fiducials off
+        Pending actions are dropped, so an interrupted exposure would otherwise leave them lit
+        """
+        if self.thread is None:
+            return
+        self._stop.set()
+        self._actions.put(None)
+        self.thread.join()
+        self.thread = None
+        self.fiducials.turn_off()
+
+    def __call__(self, event, expid, t):
+        now = time.monotonic()
+        with self._lock:
+            exposure = self.exposures.setdefault(expid, {'expid' : expid})
+            if event == 'exposure_pending':
+                exposure['announced'] = t
+                exposure['notice'] = t - now
+                self._actions.put((t - self.lead_time, 'on', expid))
+            elif event == 'exposure_start':
+                exposure['start'] = t
+            elif event == 'exposure_stop':
+                exposure['stop'] = t
+                self._actions.put((now, 'off', expid))
+
+    def _run(self):
+        while not self._stop.is_set():
+            action = self._actions.get()
+            if action is None:
+                continue
+            when, cmd, expid = action
+            if not wait_until(when, self._stop, self.spin):
+                return
+            sent = time.monotonic()
+            error = None
+            try:
+                if cmd == 'on':
+                    if self.prepared is None:
+                        self.fiducials.turn_on()
+                    else:
+                        self.fiducials.apply(self.prepared)
+                else:
+                    self.fiducials.turn_off()
+            except Exception as e:
+                error = str(e)
+            with self._lock:
+                exposure = self.exposures[expid]
+                exposure['%s_sent' % cmd] = sent
+                exposure['%s_done' % cmd] = time.monotonic()
+                if error:
+                    exposure['%s_error' % cmd] = error
+
+    def report(self):
+        """
+        Per exposure: on_latency/off_latency (command time), margin (time between fiducials on and the
+        start of the integration, negative if they came on late), led_on (time the fiducials were lit)
+        """
+        with self._lock:
+            exposures = [dict(e) for e in self.exposures.values()]
+        rows = []
+        for e in sorted(exposures, key = lambda e : e.get('announced', 0.0)):
+            row = {'expid' : e['expid'], 'error' : e.get('on_error') or e.get('off_error')}
+            if 'on_done' in e:
+                row['on_latency'] = e['on_done'] - e['on_sent']
+                row['margin'] = e.get('start', e.get('announced', e['on_done'])) - e['on_done']
+            if 'off_done' in e:
+                row['off_latency'] = e['off_done'] - e['off_sent']
+                if 'on_done' in e:
+                    row['led_on'] = e['off_done'] - e['on_done']
+            if 'start' in e and 'stop' in e:
+                row['exposure'] = e['stop'] - e['start']
+            row['lit'] = row.get('margin', -1.0) >= 0.0 and row['error'] is None
+            rows.append(row)
+        on_latency = [r['on_latency'] for r in rows if 'on_latency' in r]
+        return {'lead_time' : self.lead_time,
+                'exposures' : rows,
+                'late' : len([r for r in rows if 'margin' in r and r['margin'] < 0.0]),
+                'max_on_latency' : max(on_latency) if on_latency else None,
+                'mean_on_latency' : sum(on_latency) / len(on_latency) if on_latency else None,
+                'budget_ok' : max(on_latency) < self.lead_time if on_latency else None}
+
+class AsyncFiducials(object):
+    """
+    asyncio interface to the Fiducials class
+    The blocking calls run in a dedicated thread pool so the event loop is never blocked.
+    All calls take a timeout in seconds (default: the timeout given to the constructor).
+    On timeout or cancellation the awaiting task returns immediately; a command already sent
+    to the petal controller completes in the background.
+    """
+    def __init__(self, fiducials, timeout = None, max_workers = 4):
+        self.fiducials = fiducials
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = max_workers)
+
+    @classmethod
+    async def create(cls, device, timeout = None, max_workers = 4, **kwargs):
+        """
+        Connect to the petal controller(s) without blocking the event loop
+        kwargs are passed to Fiducials
+        """
+        loop = asyncio.get_running_loop()
+        fiducials = await asyncio.wait_for(loop.run_in_executor(None, functools.partial(Fiducials, device, **kwargs)), timeout)
+        return cls(fiducials, timeout = timeout, max_workers = max_workers)
+
+    async def _call(self, function, *args, timeout = None, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, functools.partial(getattr(self.fiducials, function), *args, **kwargs))
+        return await asyncio.wait_for(future, timeout if timeout is not None else self.timeout)
+
+    async def status(self, max_age = None, timeout = None):
+        return await self._call('status', max_age = max_age, timeout = timeout)
+
+    async def turn_on(self, level = None, force = False, timeout = None):
+        return await self._call('turn_on', level = level, force = force, timeout = timeout)
+
+    async def turn_off(self, force = False, timeout = None):
+        return await self._call('turn_off', force = force, timeout = timeout)
+
+    async def level(self, level, set_default = False, force = False, ids = None, group = None, timeout = None):
+        return await self._call('level', level, set_default = set_default, force = force, ids = ids, group = group, timeout = timeout)
+
+    async def close(self):
+        await self._call('close')
+        self._executor.shutdown(wait = False)
+
+def wait_until(target, stop, spin = 0.002):
+    """
+    Wait until time.monotonic() reaches target: sleep until spin seconds before, then busy-wait.
+    Returns False if the stop event was set.
+    """
+    remaining = target - time.monotonic()
+    if remaining > spin and stop.wait(remaining - spin):
+        return False
+    while time.monotonic() < target:
+        if stop.is_set():
+            return False
+    return not stop.is_set()
+
+def device_list(device):
+    """
+    Convert a device name, a comma separated string or a list of names to a list of device names
+    """
+    if isinstance(device, (list, tuple)):
+        names = [str(d).strip() for d in device]
+    else:
+        names = [d.strip() for d in str(device).split(',')]
+    return [name for name in names if name]
 
 
 ######################################
@@ -121,13 +914,39 @@ class FiposLED(object):
         self.CanIDs = config['CanIDs']
         self.Relative_Levels = config['Relative_Levels']
         self.Default_Duty = config['Default_Duty']
+        self.Status_TTL = float(config.get('Status_TTL', 0.0))
+        # Compact protocol: the CanBus/CanIDs layout is registered once per session
+        self.compact = bool(config.get('Compact', False))
+        self._session = None
 
         try:
-            self.pcomm=FiposComm(device,controller = config["controller"])
+            self.pcomm=FiposComm(device,controller = config["controller"], **config.get('Connection', {}))
         except Exception as e:
             raise_error('FiposComm: Cannot connect to device %s' % self.petal_controller)
+        if self.compact and (self.pcomm.serializer or Pyro4.config.SERIALIZER) == 'json':
+            self.warn('FiposLED: The json serializer cannot carry packed vectors, using the list protocol for %s' % self.petal_controller)
+            self.compact = False
         self.controller = {'devices' : self.CanIDs, 'state' : ['off' for i in range(len(self.CanIDs))], 
                            'level' : [0.0 for i in range(len(self.CanIDs))], 'default' : self.Default_Duty}
+        # Per LED state in CanID index order
+        n = len(self.CanIDs)
+        self._keys = [str(id) for id in self.CanIDs]
+        self._ids = np.asarray(self.CanIDs)
+        self._bus = np.asarray(self.CanBus)
+        self._relative = np.asarray(self.Relative_Levels, dtype=float)
+        self._relative = np.where(self._relative > 0.0, self._relative, 1.0)     # 0 means not calibrated
+        # Commanded state cache (duty last sent to the petal controller, NaN if unknown)
+        # The array is replaced, never modified in place, so commanded() doesn't need the lock
+        self._commanded = np.full(n, np.nan)
+        self._lock = threading.RLock()
+        # Status cache. _generation is incremented by every command to invalidate the cache
+        self._status_lock = threading.Lock()
+        self._status_time = None
+        self._generation = 0
+        self._refresh_thread = None
+        self._refresh_stop = threading.Event()
+        if float(config.get('Status_Refresh', 0.0)) > 0.0:
+            self.start_refresher(float(config['Status_Refresh']))
  
     def get_posfid_info(self):
         """
@@ -138,64 +957,196 @@ class FiposLED(object):
         except Exception as e:
             return 'FAILED: Can not read devices. Exception: %s' % str(e)
 
-    def status(self):
+    def status(self, max_age = None):
         """
         Get led status
-        """        
-        actual_levels = self.pcomm.call_device('get_fid_status')
-        if len(actual_levels) != len(self.controller['devices']):
-            raise_error('status: petal controller returns incorrect number of items', level='ERROR')
-        state = []
-        level = []
-        for i in range(len(self.controller['devices'])):
-            id = self.controller['devices'][i]
-            if str(id) in actual_levels:
-                value = actual_levels[str(id)]
-            else:
-                self.error('get_fid_status does not return can id %r' % id)
-                continue
-            if(-1==value):
-                state.append('unknown')
-                level.append(0.0)
-            elif(0==value):    
-                state.append('off')
-                level.append(0.0)
-            else:
-                state.append('on')
+        The last status read from the petal controller is returned if it is younger than
+        max_age seconds (default: Status_TTL). max_age = 0 forces a read.
+        """
+        ttl = self.Status_TTL if max_age is None else float(max_age)
+        with self._status_lock:
+            if ttl > 0.0 and self._status_time is not None and time.monotonic() - self._status_time < ttl:
+                return self.controller
+        return self._read_status()
+
+    def _read_status(self):
+        """
+        Read led status from the petal controller and update the status cache
+        """
+        generation = self._generation
+        packed = self._call_session('get_fid_status_packed') if self.compact else None
+        if packed is not None:
+            values = unpack_vector(packed, PACKED_DUTY)
+            if len(values) != len(self._keys):
+                raise_error('status: petal controller returns incorrect number of items', level='ERROR')
+        else:
+            actual_levels = self.pcomm.call_device('get_fid_status')
+            if len(actual_levels) != len(self.controller['devices']):
+                raise_error('status: petal controller returns incorrect number of items', level='ERROR')
+            try:
+                values = np.fromiter((actual_levels.get(key, np.nan) for key in self._keys), dtype=float, count=len(self._keys))
+            except Exception as e:
+                raise_error('status: Exception converting actual level: %s' % str(e))
+        missing = np.isnan(values)
+        if missing.any():
+            self.error('get_fid_status does not return can id(s) %r' % self._ids[missing].tolist())
+        unknown = missing | (values == -1)
+        state = np.where(unknown, -1, np.where(values == 0, 0, 1)).astype(np.int8)     # index into STATE_NAMES - 1
+        level = np.where(state == 1, np.trunc(values / self._relative), 0.0)
+        with self._status_lock:
+            self.controller['level'] = level.tolist()
+            self.controller['state'] = STATE_NAMES[state + 1].tolist()
+            # Don't cache a reading that may predate a command sent in the meantime
+            if generation == self._generation:
+                self._commanded = np.where(unknown, np.nan, values)
+                self._status_time = time.monotonic()
+        return self.controller
+
+    def _call_session(self, cmd, *args):
+        """
+        Call a compact protocol command, registering the CanBus/CanIDs layout first if needed
+        Returns None if no session could be opened; the list protocol is used for good only if
+        the petal controller does not support the compact protocol, otherwise the next command
+        tries again.
+        """
+        for attempt in range(2):
+            session = self._session
+            if session is None:
                 try:
-                    v = float(value)
+                    if not self.pcomm.has_method('open_fid_session'):
+                        self.warn('FiposLED: %s does not support the compact protocol, using the list protocol' % self.petal_controller)
+                        self.compact = False
+                        return None
+                    session = self._session = self.pcomm.call_device('open_fid_session', self.CanBus, self.CanIDs)
                 except Exception as e:
-                    raise_error('status: Exception converting actual level: %s' % str(e))
-                level.append(float(int(v/float(self.Relative_Levels[i]))))
-            self.controller['level'] = level
-            self.controller['state'] = state
-        return self.controller
+                    self.warn('FiposLED: Cannot open a compact session with %s: %s' % (self.petal_controller, str(e)))
+                    return None
+            try:
+                return self.pcomm.call_device(cmd, session, *args)
+            except RuntimeError as e:
+                # The petal controller restarted and forgot the session
+                if attempt > 0 or 'unknown session' not in str(e):
+                    raise
+                self._session = None
+
+    def _send(self, changed, values):
+        """
+        Send the duty values for the LEDs at positions changed
+        """
+        if self.compact:
+            indices = None if len(changed) == len(self.CanIDs) else pack_vector(changed, PACKED_INDEX)
+            reply = self._call_session('set_fid_packed', pack_vector(values, PACKED_DUTY), indices)
+            if reply is not None:
+                return reply
+        return self.pcomm.call_device('set_fiducials', self._bus[changed].tolist(), self._ids[changed].tolist(), values.tolist())
+
+    def invalidate(self):
+        """
+        Discard the cached status
+        """
+        with self._status_lock:
+            self._generation += 1
+            self._status_time = None
+
+    def start_refresher(self, interval):
+        """
+        Start a background thread that reads the status every interval seconds
+        """
+        self.stop_refresher()
+        self._refresh_stop.clear()
+        self._refresh_thread = threading.Thread(target=self._refresh, args=(float(interval),))
+        self._refresh_thread.setDaemon(True)
+        self._refresh_thread.start()
+        self.info('FiposLED: status refresher for %s running. Interval %s' % (self.petal_controller, str(interval)))
+
+    def stop_refresher(self):
+        if self._refresh_thread is not None:
+            self._refresh_stop.set()
+            self._refresh_thread.join()
+            self._refresh_thread = None
+
+    def _refresh(self, interval):
+        while not self._refresh_stop.wait(interval):
+            try:
+                self._read_status()
+            except Exception as e:
+                self.warn('FiposLED: status refresh for %s failed: %s' % (self.petal_controller, str(e)))
+
+    def close(self):
+        self.stop_refresher()
+        if self.pcomm is not None:
+            self.pcomm.close()
         
-    def turn_on(self, level = None):
+    def turn_on(self, level = None, force = False):
         """
         Turn on the LEDs by setting the duty to the default value
         """
-        return self.level(level if level != None else self.Default_Duty)
+        return self.level(level if level != None else self.Default_Duty, force = force)
         
-    def turn_off(self):
+    def turn_off(self, force = False):
         """
         Disable the LED channel
         """
-        return self.level(0)
+        return self.level(0, force = force)
 
-    def level(self, percent_duty, set_default = False):
+    def level(self, percent_duty, set_default = False, force = False, indices = None):
         """
         Set the LED value
+        indices selects the LEDs (positions in CanIDs) percent_duty applies to (default: all)
+        Only the CanIDs whose duty differs from the commanded state are sent to the petal
+        controller, the call is skipped if nothing changed.
+        force = True sends the full duty list (resync with the petal controller)
         """
-        if not isinstance(percent_duty, list):
-            percent_duty = [percent_duty for i in range(len(self.CanIDs))]
-        if set_default == True:
-            self.Default_Duty = percent_duty
-            self.controller['default'] = percent_duty
-        try:
-            return self.pcomm.call_device('set_fiducials', self.CanBus, self.CanIDs, percent_duty)
-        except Exception as e:
-            raise_error('Exception setting level: %s'% str(e), level='ERROR', function= 'level')
+        indices = np.arange(len(self.CanIDs)) if indices is None else np.asarray(indices, dtype=int)
+        duty = duty_vector(percent_duty, len(indices))
+        with self._lock:
+            if set_default == True:
+                default = duty_vector(self.Default_Duty, len(self.CanIDs))
+                default[indices] = duty
+                self.Default_Duty = default.tolist()
+                self.controller['default'] = self.Default_Duty
+            if force:
+                send = np.ones(len(indices), dtype=bool)
+            else:
+                send = self._commanded[indices] != duty     # NaN (unknown) always differs
+            changed = indices[send]
+            if len(changed) == 0:
+                return SUCCESS
+            values = duty[send]
+            self.invalidate()
+            try:
+                reply = self._send(changed, values)
+            except Exception as e:
+                # The state of these LEDs is unknown now
+                self._commanded = self._update(changed, np.nan)
+                raise_error('Exception setting level: %s'% str(e), level='ERROR', function= 'level')
+            failed = isinstance(reply, str) and 'FAIL' in reply.upper()
+            self._commanded = self._update(changed, np.nan if failed else values)
+            self.invalidate()
+            return reply
+
+    def commanded(self):
+        """
+        Returns the commanded duty per CanID (None if unknown)
+        """
+        commanded = self._commanded
+        return [None if np.isnan(v) else float(v) for v in commanded]
+
+    def _update(self, indices, values):
+        """
+        Copy of the commanded state with values set at indices
+        """
+        commanded = self._commanded.copy()
+        commanded[indices] = values
+        return commanded
+
+    def resync(self):
+        """
+        Send the full commanded state to the petal controller
+        LEDs with unknown state are turned off
+        """
+        with self._lock:
+            return self.level(np.nan_to_num(self._commanded, nan=0.0).tolist(), force = True)
         
             
 ######################################
@@ -224,51 +1175,206 @@ class SimulatorLED(object):
         self.controller = {'devices' : self.CanIDs, 'state' : ['off' for i in range(len(self.CanIDs))], 
                            'level' : [0.0 for i in range(len(self.CanIDs))], 'default' : self.Default_Duty}
  
-    def status(self):
+    def status(self, max_age = None):
         """
         Get led status
         """
         return self.controller
 
-    def turn_on(self, level = None):
+    def commanded(self):
+        return list(self.controller['level'])
+
+    def turn_on(self, level = None, force = False):
         """
         Turn on the LEDs by setting the duty to the default value
         """
         return self.level(self.Default_Duty)
         
-    def turn_off(self, level = None):
+    def turn_off(self, level = None, force = False):
         """
         Disable the LED channel
         """
         return self.level(0)
 
-    def level(self, value, set_default = False):
+    def level(self, value, set_default = False, force = False, indices = None):
         """
         Set the LED value
         """
-        on_flag = False
-        if isinstance(value,list):
-                for value_i in value:
-                        if value_i > 0.00001:
-                                on_flag = True
-        else:
-                if value > 0.00001:
-                        on_flag = True
-        if on_flag is False:
+        if indices is not None:
+            return self._level_subset(value, set_default, np.asarray(indices, dtype=int))
+        if isinstance(value, list) and len(value) != len(self.CanIDs):
+            print(len(value),len(self.CanIDs))
+            raise_error('Incorrect list length', level='ERROR')
+        duty = duty_vector(value, len(self.CanIDs))
+        if not (duty > 0.00001).any():
             self.controller['state'] = ['off' for i in range(len(self.CanIDs))]
             self.controller['level'] = [0.0  for i in range(len(self.CanIDs))]
         else:
             self.controller['state'] = ['on'  for i in range(len(self.CanIDs))]
-            if isinstance(value, list):
-                if len(value) == len(self.CanIDs):
-                    self.controller['level'] = value
-                else:
-                    print(len(value),len(self.CanIDs))
-                    raise_error('Incorrect list length', level='ERROR')
-            else:
-                self.controller['level'] = [value  for i in range(len(self.CanIDs))]
+            self.controller['level'] = duty.tolist()
             if set_default == True:
                 self.controller['default'] = self.controller['level']
+                self.Default_Duty = self.controller['default']
+
+    def _level_subset(self, value, set_default, indices):
+        level = np.asarray(self.controller['level'], dtype=float)
+        level[indices] = duty_vector(value, len(indices))
+        self.controller['level'] = level.tolist()
+        self.controller['state'] = np.where(level > 0.00001, 'on', 'off').tolist()
+        if set_default == True:
+            default = duty_vector(self.controller['default'], len(self.CanIDs))
+            default[indices] = level[indices]
+            self.controller['default'] = default.tolist()
+            self.Default_Duty = self.controller['default']
+
+#################################################################################
+#
+# Per LED state codes and duty vectors
+#
+#################################################################################
+STATE_NAMES = np.array(['unknown', 'off', 'on'])     # indexed by state code + 1
+
+def duty_vector(value, n):
+    """
+    Convert a scalar or a list of n duty values to a float array
+    """
+    if isinstance(value, (list, tuple, np.ndarray)):
+        duty = np.asarray(value, dtype=float)
+        if duty.shape != (n,):
+            raise_error('level: Incorrect list length %d (expected %d)' % (len(duty), n), level='ERROR', function='level')
+        return duty
+    return np.full(n, float(value))
+
+# Compact protocol vectors (little endian, CanID index order)
+PACKED_DUTY = '<f8'
+PACKED_INDEX = '<i4'
+
+def pack_vector(values, dtype):
+    return np.asarray(values).astype(dtype).tobytes()
+
+def unpack_vector(data, dtype):
+    """
+    Convert a packed vector received over Pyro to an array (serpent transfers bytes as a dictionary)
+    """
+    if isinstance(data, dict):
+        data = serpent.tobytes(data)
+    return np.frombuffer(bytes(data), dtype=dtype).astype(float)
+
+#################################################################################
+#
+# Discovery cache: last known address of each petal controller
+#
+#################################################################################
+DISCOVERY_CACHE = os.path.join(os.path.expanduser('~'), '.fipos_discovery.json')
+_discovery_lock = threading.Lock()
+
+def load_discovery_cache(filename):
+    """
+    Returns the discovery cache {device : device information}, {} if the file can't be read
+    """
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except Exception:
+        return {}
+
+def save_discovery_cache(filename, device, info):
+    """
+    Store the address information for device in the discovery cache
+    """
+    entry = {key : str(value) for key, value in info.items() if key in ['pyro_uri', 'uid', 'node', 'name', 'service', 'stype', 'device_instance', 'connected2instance']}
+    entry['cached'] = datetime.datetime.utcnow().isoformat()
+    with _discovery_lock:
+        cache = load_discovery_cache(filename)
+        cache[device] = entry
+        try:
+            tmp = '%s.%d.tmp' % (filename, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(cache, f, indent=2, sort_keys=True)
+            os.replace(tmp, filename)
+        except Exception as e:
+            if hasattr(Log, 'warn'):
+                Log.warn('save_discovery_cache: Cannot write %s: %s' % (filename, str(e)))
+
+STATE_SNAPSHOT = os.path.join(os.path.expanduser('~'), '.cifids_state.json')
+_snapshot_lock = threading.Lock()
+
+def load_state_snapshot(filename):
+    """
+    Returns the saved fiducial state {device : {'CanIDs', 'level', 'default', 'saved'}}, {} if the file can't be read
+    """
+    try:
+        with open(filename) as f:
+            snapshot = json.load(f)
+        return snapshot if isinstance(snapshot, dict) else {}
+    except Exception:
+        return {}
+
+def save_state_snapshot(filename, snapshot):
+    """
+    Store the snapshot entries (see Fiducials.snapshot) in the state file, entries of other devices are kept
+    """
+    saved = datetime.datetime.utcnow().isoformat()
+    with _snapshot_lock:
+        state = load_state_snapshot(filename)
+        for device, entry in snapshot.items():
+            state[device] = dict(entry, saved = saved)
+        try:
+            tmp = '%s.%d.tmp' % (filename, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+            os.replace(tmp, filename)
+        except Exception as e:
+            if hasattr(Log, 'warn'):
+                Log.warn('save_state_snapshot: Cannot write %s: %s' % (filename, str(e)))
+
+class SnapshotWriter(object):
+    """
+    Saves state snapshots from a background thread, at most once every interval seconds
+    snapshot is a function returning the snapshot to save (None: nothing to save). It is called
+    when the file is written, so a burst of requests results in a single write of the latest state.
+    """
+    def __init__(self, filename, snapshot, interval = 0.5):
+        self.filename = filename
+        self.snapshot = snapshot
+        self.interval = float(interval)
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def request(self):
+        """
+        Mark the state as changed
+        """
+        self._dirty.set()
+
+    def write(self):
+        snapshot = self.snapshot()
+        if snapshot:
+            save_state_snapshot(self.filename, snapshot)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._dirty.wait()
+            self._dirty.clear()
+            try:
+                self.write()
+            except Exception as e:
+                if hasattr(Log, 'warn'):
+                    Log.warn('SnapshotWriter: %s' % str(e))
+            self._stop.wait(self.interval)
+
+    def close(self):
+        """
+        Stop the writer thread and save the current state
+        """
+        self._stop.set()
+        self._dirty.set()
+        self.thread.join()
+        self.write()
 
 #################################################################################
 class FiposComm(object):
@@ -279,7 +1385,16 @@ class FiposComm(object):
     def __init__(self, device, **options):
         """
         Find the petal controller (device) and connect to it
-        Options include the fipos settings for LED control
+        Options include the fipos settings for LED control and the connection settings
+            timeout             Pyro call timeout in seconds (None: no timeout)
+            max_connections     maximum number of concurrent calls (size of the proxy pool)
+            retries             number of retries after a communication error
+            backoff             initial retry delay in seconds, doubled for every retry up to backoff_max
+            breaker_threshold   consecutive failures that open the circuit breaker
+            breaker_reset       seconds the breaker stays open (doubled if the controller stays down)
+            keepalive           ping interval for idle connections in seconds (0 disables the keepalive)
+            serializer          Pyro serializer (serpent, marshal, json, pickle; None: Pyro default)
+            cache_file          file with the last known address of each petal controller (None disables the cache)
         """
         # Log functions
         for level in ['msg', 'debug', 'info', 'warn', 'error']:
@@ -293,10 +1408,35 @@ class FiposComm(object):
         self.repeat.clear()
         self.found_controller = threading.Event()
         self.found_controller.clear()
+        self.confirmed = False
         self.stype = '-dos-'
         self.service = options.get('service', 'PetalControl')
         self.device = {}
         delay = options.get('delay', 15.0)
+        # Connection management
+        self.timeout = options.get('timeout', None)
+        self.max_connections = int(options.get('max_connections', 4))
+        self.retries = int(options.get('retries', 2))
+        self.backoff = float(options.get('backoff', 0.1))
+        self.backoff_max = float(options.get('backoff_max', 5.0))
+        self.breaker_threshold = int(options.get('breaker_threshold', 5))
+        self.breaker_reset = float(options.get('breaker_reset', 10.0))
+        self.breaker_max = float(options.get('breaker_max', 300.0))
+        self.keepalive = float(options.get('keepalive', 30.0))
+        self.serializer = options.get('serializer') or None
+        self._idle = collections.deque()      # idle (epoch, proxy) pairs
+        self._epoch = 0                       # incremented when the controller address changes
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        self._state_lock = threading.Lock()
+        self._failures = 0
+        self._open_count = 0
+        self._open_until = 0.0
+        self.health = 'unknown'
+        self.last_error = None
+        self.keepalive_thread = None
+        self._keepalive_stop = threading.Event()
+        self.cache_file = options.get('cache_file', DISCOVERY_CACHE)
         # Did we get controller information or should we seek?
         print('89755')
         print(options)
@@ -321,41 +1461,100 @@ class FiposComm(object):
                                                              str(options['controller']['port']))
                 print(self.device['pyro_uri'])
         else:
+            # Try the last known address first, the Seeker confirms or updates it in the background
+            cached = load_discovery_cache(self.cache_file).get(self.petal_controller) if self.cache_file else None
+            if cached and 'pyro_uri' in cached:
+                self.device = dict(cached)
+                if self._probe():
+                    self.info('Using cached address %s for device %s' % (self.device['pyro_uri'], self.petal_controller))
+                    self.found_controller.set()
+                else:
+                    self.info('Cached address %s for device %s is stale' % (self.device['pyro_uri'], self.petal_controller))
+                    self.device = {}
+                    self._flush()
             # Setup DOS Seeker
             self.seeker = Seeker(self.stype, self.service, found_callback = self._found_dev)
             # Start Seeker thread
             self.repeat.set()
             self.delay = 0.5
+            self.seek_window = delay + 1.0
             self.seeker_thread = threading.Thread(target=self._repeat_seeker)
             self.seeker_thread.setDaemon(True)
             self.seeker_thread.start()
             self.info('Seeker thread is now running. Delay %s' % str(self.delay))
-            # wait briefly for seeker to find all devices
-            self.info('Waiting for device %s' % self.petal_controller)
-            self.found_controller.wait(timeout = delay + 1.0)
-            self.delay = 10.0
-
-        # Make sure we have a device to connect to
-        start = time.time()
-        while self.device == {} and delay<(time.time() - start):
-            self.device['proxy'] = Pyro4.Proxy(self.device['pyro_uri'])
-            self.info('Now connected to device %s' % self.device)
-            break
-            
+            if not self.found_controller.is_set():
+                # wait briefly for seeker to find all devices
+                self.info('Waiting for device %s' % self.petal_controller)
+                self.found_controller.wait(timeout = delay + 1.0)
+                self.delay = 10.0
+
+        # Make sure we have a device to connect to. Proxies are created on demand.
         if self.device == {}:
             raise_error('fipos_comm: Timeout connecting to controller %s' % (self.petal_controller), level='ERROR', function='init')
 
+        if self.keepalive > 0.0:
+            self.keepalive_thread = threading.Thread(target=self._keepalive)
+            self.keepalive_thread.setDaemon(True)
+            self.keepalive_thread.start()
+
     def is_connected(self):
         """
         Returns the status of the found_controller flag.
         """
         return self.found_controller.is_set()
+
+    def connection_status(self):
+        """
+        Returns the health of the connection to the petal controller
+        health is 'ok', 'slow' (last call timed out), 'dead' (communication failure) or 'unknown'
+        """
+        with self._state_lock:
+            remaining = self._open_until - time.monotonic()
+            return {'health' : self.health,
+                    'breaker' : 'open' if remaining > 0.0 else 'closed',
+                    'breaker_remaining' : max(0.0, remaining),
+                    'consecutive_failures' : self._failures,
+                    'idle_connections' : len(self._idle),
+                    'last_error' : self.last_error}
+
+    def close(self):
+        """
+        Stop the keepalive and seeker threads and release all connections
+        """
+        self.repeat.clear()
+        self._keepalive_stop.set()
+        if self.keepalive_thread is not None:
+            self.keepalive_thread.join()
+            self.keepalive_thread = None
+        self._flush()
     
     # Internal callback and utility functions
     def _repeat_seeker(self):
+        start = time.monotonic()
         while self.repeat.is_set():
             self.seeker.seek()
             time.sleep(self.delay)
+            # slow down once the device is confirmed or the initial search window has passed
+            if self.delay < 10.0 and (self.confirmed or time.monotonic() - start > self.seek_window):
+                self.delay = 10.0
+
+    def _probe(self, timeout = 2.0):
+        """
+        Check that the petal controller answers at self.device['pyro_uri']
+        """
+        try:
+            epoch, proxy = self._checkout()
+        except Exception:
+            return False
+        try:
+            proxy._pyroTimeout = min(float(self.timeout), timeout) if self.timeout else timeout
+            proxy._pyroGetMetadata()
+        except Exception as e:
+            self._checkin(epoch, proxy, False)
+            return False
+        proxy._pyroTimeout = float(self.timeout) if self.timeout else None
+        self._checkin(epoch, proxy, True)
+        return True
 
     def _found_dev(self, dev):
         for key in dev:
@@ -367,29 +1566,191 @@ class FiposComm(object):
                         self.info('_found_dev: Found new device %s' % str(key))
                         self.device['name'] = key
                     # update proxy information?
-                    if 'uid' in self.device and self.device['uid'] != dev[key]['uid']:
+                    changed = self.device.get('uid') != dev[key].get('uid') or self.device.get('pyro_uri') != dev[key].get('pyro_uri')
+                    if 'uid' in self.device and changed:
                         self.info('_found_dev: Device %s rediscovered.' % key)
-                        if 'proxy' in self.device:     # remove potentially stale info
-                            del self.device['proxy']
+                        self._flush()     # remove potentially stale connections
                     self.device.update(dev[key])   # make a copy
+                    self.confirmed = True
                     self.found_controller.set()
+                    if changed and self.cache_file:
+                        save_discovery_cache(self.cache_file, key, self.device)
                         
+    # Connection pool and circuit breaker
+    def _flush(self):
+        """
+        Release all idle connections. Connections in use are dropped when they are returned.
+        """
+        with self._pool_lock:
+            self._epoch += 1
+            idle = list(self._idle)
+            self._idle.clear()
+        for epoch, proxy in idle:
+            self._release(proxy)
+
+    def _release(self, proxy):
+        try:
+            proxy._pyroRelease()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        """
+        Returns an idle (epoch, proxy) pair or a new proxy
+        """
+        with self._pool_lock:
+            if self._idle:
+                return self._idle.pop()
+            epoch = self._epoch
+        if 'pyro_uri' not in self.device:
+            raise RuntimeError('call_device: remote device not reachable %s' % ('' if 'name' not in self.device else self.device))
+        proxy = Pyro4.Proxy(self.device['pyro_uri'])
+        if self.serializer:
+            proxy._pyroSerializer = self.serializer
+        if self.timeout:
+            proxy._pyroTimeout = float(self.timeout)
+        return epoch, proxy
+
+    def has_method(self, name):
+        """
+        True if the remote object exposes the method name (from the Pyro metadata of a pooled proxy)
+        """
+        if self._breaker_open():
+            raise RuntimeError('has_method: %s is %s. Last error: %s' % (self.petal_controller, self.health, self.last_error))
+        epoch, proxy = self._checkout()
+        try:
+            if not proxy._pyroMethods:
+                proxy._pyroGetMetadata()
+        except Pyro4.errors.CommunicationError as e:
+            self._checkin(epoch, proxy, False)
+            raise RuntimeError('has_method: Cannot read the metadata of %s: %s' % (self.petal_controller, str(e)))
+        self._checkin(epoch, proxy, True)
+        return name in proxy._pyroMethods
+
+    def _checkin(self, epoch, proxy, healthy):
+        """
+        Return a proxy to the pool. Broken or stale proxies are released.
+        """
+        with self._pool_lock:
+            if healthy and epoch == self._epoch and len(self._idle) < self.max_connections:
+                self._idle.append((epoch, proxy))
+                return
+        self._release(proxy)
+
+    def _breaker_open(self):
+        with self._state_lock:
+            return self._open_until > time.monotonic()
+
+    def _record_success(self):
+        with self._state_lock:
+            self._failures = 0
+            self._open_count = 0
+            self._open_until = 0.0
+            self.health = 'ok'
+
+    def _record_failure(self, health, error):
+        with self._state_lock:
+            self._failures += 1
+            self.health = health
+            self.last_error = str(error)
+            if self._failures >= self.breaker_threshold:
+                reset = min(self.breaker_reset * 2 ** self._open_count, self.breaker_max)
+                self._open_until = time.monotonic() + reset
+                self._open_count += 1
+                self.warn('FiposComm: %s is %s, no calls for %.1f seconds after %d failures' % (self.petal_controller, health, reset, self._failures))
+
+    def _backoff(self, attempt):
+        """
+        Exponential backoff with jitter so that many callers don't reconnect in lockstep
+        """
+        return min(self.backoff * 2 ** attempt, self.backoff_max) * random.uniform(0.5, 1.0)
+
+    def _keepalive(self):
+        """
+        Ping idle connections so that they stay open (and broken ones are detected early)
+        One connection is taken out of the pool at a time, the others remain available to callers.
+        The oldest is taken and checked in at the other end, so each is pinged once per pass.
+        """
+        while not self._keepalive_stop.wait(self.keepalive):
+            if self._breaker_open() or 'pyro_uri' not in self.device:
+                continue
+            with self._pool_lock:
+                count = len(self._idle)
+            for i in range(max(1, count)):
+                with self._pool_lock:
+                    entry = self._idle.popleft() if self._idle else None
+                if entry is None:
+                    if count:
+                        break
+                    try:
+                        entry = self._checkout()
+                    except Exception:
+                        break
+                epoch, proxy = entry
+                try:
+                    proxy._pyroGetMetadata()
+                except Pyro4.errors.CommunicationError as e:
+                    self._checkin(epoch, proxy, False)
+                    self._record_failure('slow' if isinstance(e, Pyro4.errors.TimeoutError) else 'dead', e)
+                    continue
+                except Exception as e:
+                    self._checkin(epoch, proxy, False)
+                    continue
+                self._checkin(epoch, proxy, True)
+                self._record_success()
+
     def call_device(self, cmd, *args, **kwargs):
         """
         Call remote function
         Input:  cmd   = function name
                 args, kwargs are passed to the remove function
         Returns: return value received from remote function
+        Communication errors are retried with exponential backoff. Timeouts are not retried
+        (the controller is slow, not gone), neither are protocol/serialization errors. After
+        breaker_threshold consecutive failures calls fail immediately until the breaker resets.
         """
+        name = 'rpc.%s' % str(cmd)
+        if self._breaker_open():
+            perf_stats.count(name, 'rejected')
+            raise RuntimeError('call_device: %s is %s, command %s rejected. Last error: %s' % (self.petal_controller, self.health, str(cmd), self.last_error))
+        if not self._slots.acquire(timeout = self.timeout):
+            perf_stats.count(name, 'rejected')
+            raise RuntimeError('call_device: No connection to %s available for command %s' % (self.petal_controller, str(cmd)))
         try:
-            return getattr(self.device['proxy'],cmd)(*args, **kwargs)
-        except:
-            if 'pyro_uri' in self.device:
-                try:
-                    self.device['proxy'] = Pyro4.Proxy(self.device['pyro_uri'])
-                    return getattr(self.device['proxy'],cmd)(*args, **kwargs)
-                except Exception as e:
-                    raise RuntimeError('call_device: Exception for command %s. Message: %s' % (str(cmd),str(e)))
-            # Failed to get status from device
-            raise RuntimeError('call_device: remote device not reachable %s' % '' if 'name' not in self.device else self.device)
+            with perf_stats.timer(name):
+                return self._call_device(name, cmd, *args, **kwargs)
+        finally:
+            self._slots.release()
 
+    def _call_device(self, name, cmd, *args, **kwargs):
+        attempt = 0
+        while True:
+            epoch, proxy = self._checkout()
+            try:
+                result = getattr(proxy,cmd)(*args, **kwargs)
+            except Pyro4.errors.TimeoutError as e:
+                self._checkin(epoch, proxy, False)
+                self._record_failure('slow', e)
+                perf_stats.count(name, 'timeouts')
+                raise RuntimeError('call_device: Timeout for command %s. Message: %s' % (str(cmd),str(e)))
+            except Pyro4.errors.ProtocolError as e:
+                # Includes SerializeError: a bad argument or serializer, not a dead controller
+                self._checkin(epoch, proxy, False)
+                raise RuntimeError('call_device: Protocol error for command %s. Message: %s' % (str(cmd),str(e)))
+            except Pyro4.errors.CommunicationError as e:
+                self._checkin(epoch, proxy, False)
+                self._record_failure('dead', e)
+                if attempt >= self.retries or self._breaker_open():
+                    raise RuntimeError('call_device: Exception for command %s. Message: %s' % (str(cmd),str(e)))
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                perf_stats.count(name, 'reconnects')
+                continue
+            except Exception as e:
+                # Raised by the remote function, the connection itself is fine
+                self._checkin(epoch, proxy, True)
+                self._record_success()
+                raise RuntimeError('call_device: Exception for command %s. Message: %s' % (str(cmd),str(e)))
+            self._checkin(epoch, proxy, True)
+            self._record_success()
+            return result
@@ -0,0 +1,330 @@
+"""
+   Concurrent load/soak test for the fiducial command path
+   Starts a number of local PetalControl stand-ins (petal_standin.py) and a number of client
+   threads that issue a mix of set_fid_on, set_fid_off, duty_cycle and get_fid_status operations
+   against a Fiducials object driving all stand-ins (shared by all clients, or one per client with --private).
+   The stand-ins run in their own processes so that they neither add to the reported memory nor
+   compete with the clients for the interpreter lock (--inprocess runs them in this process).
+   Reports throughput, tail latency and errors per operation, the memory growth of the process
+   (RSS and tracemalloc) over the run and consistency problems of the status returned by the
+   controllers (the FiposLED.controller dictionary is shared between the client threads).
+
+   Example:
+   python loadtest_fiducials.py --standins 10 --canids 24 --clients 16 --duration 600 --latency uniform:0.005,0.02
+   python loadtest_fiducials.py --clients 64 --mix set_fid_on:1,duty_cycle:4,get_fid_status:10 --rate 5 --output soak.json
+
+   Operations:
+      set_fid_on        Fiducials.turn_on with the default duty (as CIFIDS.set_fid_on)
+      set_fid_off       Fiducials.turn_off
+      duty_cycle        Fiducials.level with random duties, a quarter of them 0 (as CIFIDS.duty_cycle)
+      get_fid_status    Fiducials.status, the result is checked for consistency
+"""
+import time, os, sys
+import json
+import random
+import argparse
+import platform
+import datetime
+import threading
+import tracemalloc
+import subprocess
+import atexit
+
+from fiducials import Fiducials, perf_stats
+from petal_standin import start_standin
+from bench_fiducials import summarize, git_revision
+
+OPERATIONS = ['set_fid_on', 'set_fid_off', 'duty_cycle', 'get_fid_status']
+STATES = ['on', 'off', 'unknown']
+
+def parse_mix(text):
+    """
+    Convert 'set_fid_on:1,duty_cycle:3,get_fid_status:6' to a list of (operation, cumulative weight)
+    """
+    mix = []
+    total = 0.0
+    for part in text.split(','):
+        name, _, weight = part.partition(':')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError('Unknown operation %r' % name)
+        total += float(weight) if weight else 1.0
+        mix.append((name, total))
+    return [(name, weight / total) for name, weight in mix]
+
+def rss():
+    """
+    Resident set size of the process in bytes (None if not available)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    except Exception:
+        return None
+
+def check_status(status, n):
+    """
+    Returns a list of consistency problems of a status dictionary covering n fiducials
+    """
+    problems = []
+    for key in ['devices', 'state', 'level']:
+        if len(status[key]) != n:
+            problems.append('%s has %d entries (expected %d)' % (key, len(status[key]), n))
+    if problems:
+        return problems
+    for id, state, level in zip(status['devices'], status['state'], status['level']):
+        if state not in STATES:
+            problems.append('CanID %s: invalid state %r' % (id, state))
+        elif state == 'on' and not level > 0.0:
+            problems.append('CanID %s: state on with level %r' % (id, level))
+        elif state == 'off' and level != 0.0:
+            problems.append('CanID %s: state off with level %r' % (id, level))
+    return problems
+
+class LoadClient(threading.Thread):
+    """
+    Client thread issuing operations until stop is set
+    rate is the target operation rate in Hz (0: back to back)
+    """
+    def __init__(self, number, fiducials, mix, rate, stop, default):
+        threading.Thread.__init__(self, name = 'client%d' % number)
+        self.setDaemon(True)
+        self.fiducials = fiducials
+        self.mix = mix
+        self.rate = float(rate)
+        self.stop = stop
+        self.default = default
+        self.random = random.Random(number)
+        self.n = len(fiducials.keys())
+        self.lock = threading.Lock()
+        self.latencies = {op : [] for op in OPERATIONS}
+        self.errors = {op : {} for op in OPERATIONS}
+        self.problems = []
+
+    def _choose(self):
+        x = self.random.random()
+        for name, weight in self.mix:
+            if x <= weight:
+                return name
+        return self.mix[-1][0]
+
+    def run(self):
+        start = time.perf_counter()
+        k = 0
+        while not self.stop.is_set():
+            if self.rate > 0:
+                delay = start + k / self.rate - time.perf_counter()
+                if delay > 0 and self.stop.wait(delay):
+                    return
+            k += 1
+            op = self._choose()
+            t0 = time.perf_counter()
+            try:
+                if op == 'set_fid_on':
+                    self.fiducials.turn_on(level = self.default)
+                elif op == 'set_fid_off':
+                    self.fiducials.turn_off()
+                elif op == 'duty_cycle':
+                    self.fiducials.level([0.0 if self.random.random() < 0.25 else float(self.random.randint(1, 100)) for i in range(self.n)])
+                else:
+                    status = self.fiducials.status()
+            except Exception as e:
+                with self.lock:
+                    kind = type(e).__name__
+                    self.errors[op][kind] = self.errors[op].get(kind, 0) + 1
+                continue
+            elapsed = time.perf_counter() - t0
+            problems = check_status(status, self.n) if op == 'get_fid_status' else []
+            with self.lock:
+                self.latencies[op].append(elapsed)
+                if problems:
+                    self.problems.extend(problems[:5])
+
+    def collect(self):
+        """
+        Returns and clears the latencies and errors collected since the last call
+        """
+        with self.lock:
+            latencies, errors, problems = self.latencies, self.errors, self.problems
+            self.latencies = {op : [] for op in OPERATIONS}
+            self.errors = {op : {} for op in OPERATIONS}
+            self.problems = []
+        return latencies, errors, problems
+
+def spawn_standin(name, can_ids, args):
+    """
+    Start petal_standin.py in a subprocess
+    Returns (process, controller) where controller is the FiposLED controller option
+    """
+    command = [sys.executable, '-u', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'petal_standin.py'),
+               '--device', name, '--canids', '%d-%d' % (can_ids[0], can_ids[-1]),
+               '--drop_rate', str(args.drop_rate), '--drop_delay', str(2 * args.timeout)]
+    if args.latency is not None:
+        command += ['--latency', args.latency]
+    process = subprocess.Popen(command, stdout = subprocess.PIPE, universal_newlines = True)
+    atexit.register(process.terminate)     # also if the test fails
+    line = process.stdout.readline()
+    if 'running at' not in line:
+        process.kill()
+        raise RuntimeError('Stand-in %s did not start: %r' % (name, line))
+    host, _, port = line.split()[-1].rpartition(':')
+    return process, {'ip' : host, 'port' : port}
+
+def make_fiducials(devices, controllers, can_ids, args):
+    options = {'CanIDs' : can_ids,
+               'CanBus' : ['can0' for i in range(len(can_ids))],
+               'Relative_Levels' : [1.0 for i in range(len(can_ids))],
+               'Default_Duty' : [50.0 for i in range(len(can_ids))],
+               'Status_TTL' : args.status_ttl,
+               'Connection' : {'timeout' : args.timeout, 'max_connections' : args.max_connections, 'keepalive' : 0.0}}
+    for name in devices:
+        options[name] = {'controller' : controllers[name]}
+    return Fiducials(devices, controller_type = 'fiposled', device_options = options, max_workers = args.max_workers)
+
+def verify(fiducials):
+    """
+    Compare the commanded state with the status read from the stand-ins once the clients stopped
+    Returns the number of fiducials whose commanded level differs from the petal controller
+    """
+    commanded = fiducials.commanded()
+    status = fiducials.status(max_age = 0)
+    return sum(1 for c, level in zip(commanded, status['level']) if c is not None and int(c) != int(level))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Concurrent load/soak test of the fiducial command path')
+    parser.add_argument('--standins', type = int, default = 4, help = 'number of petal controller stand-ins')
+    parser.add_argument('--canids', type = int, default = 24, help = 'CanIDs per stand-in')
+    parser.add_argument('--clients', type = int, default = 8, help = 'number of client threads')
+    parser.add_argument('--private', action = 'store_true', help = 'one Fiducials object per client instead of a shared one')
+    parser.add_argument('--mix', default = 'set_fid_on:1,set_fid_off:1,duty_cycle:3,get_fid_status:6', help = 'operation weights')
+    parser.add_argument('--inprocess', action = 'store_true', help = 'run the stand-ins in this process')
+    parser.add_argument('--rate', type = float, default = 0.0, help = 'operations per second per client, 0 = back to back')
+    parser.add_argument('--duration', type = float, default = 60.0, help = 'run time in seconds')
+    parser.add_argument('--interval', type = float, default = 10.0, help = 'report interval in seconds')
+    parser.add_argument('--latency', default = None, help = 'stand-in latency specification (see petal_standin.py)')
+    parser.add_argument('--drop_rate', type = float, default = 0.0, help = 'stand-in drop rate')
+    parser.add_argument('--timeout', type = float, default = 10.0, help = 'rpc timeout')
+    parser.add_argument('--max_connections', type = int, default = 4)
+    parser.add_argument('--max_workers', type = int, default = 10)
+    parser.add_argument('--status_ttl', type = float, default = 0.0)
+    parser.add_argument('--tracemalloc', action = 'store_true', help = 'trace python allocations (slower)')
+    parser.add_argument('--output', default = None, help = 'JSON result file')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    can_ids = list(range(1000, 1000 + args.canids))
+    devices = ['PC%02d' % i for i in range(args.standins)]
+    standins = []
+    controllers = {}
+    for name in devices:
+        if args.inprocess:
+            daemon, controllers[name] = start_standin(name, can_ids = can_ids, latency = args.latency, drop_rate = args.drop_rate, drop_delay = 2 * args.timeout)
+            standins.append(daemon.shutdown)
+        else:
+            process, controllers[name] = spawn_standin(name, can_ids, args)
+            standins.append(process.terminate)
+
+    if args.tracemalloc:
+        tracemalloc.start(10)
+    shared = None if args.private else make_fiducials(devices, controllers, can_ids, args)
+    default = [50.0 for i in range(len(devices) * len(can_ids))]
+    stop = threading.Event()
+    clients = [LoadClient(i, shared or make_fiducials(devices, controllers, can_ids, args), mix, args.rate, stop, default) for i in range(args.clients)]
+
+    totals = {op : {'latencies' : [], 'errors' : {}} for op in OPERATIONS}
+    problems = []
+    samples = []
+    baseline = tracemalloc.take_snapshot() if args.tracemalloc else None
+    print('%8s %10s %10s %10s %8s %10s %10s' % ('time [s]', 'ops/s', 'p50 [ms]', 'p99 [ms]', 'errors', 'rss [MB]', 'traced [MB]'))
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    try:
+        last = start
+        while True:
+            remaining = start + args.duration - time.perf_counter()
+            if remaining <= 0:
+                break
+            time.sleep(min(args.interval, remaining))
+            now = time.perf_counter()
+            latencies = []
+            errors = 0
+            for client in clients:
+                l, e, p = client.collect()
+                problems.extend(p)
+                for op in OPERATIONS:
+                    totals[op]['latencies'].extend(l[op])
+                    latencies.extend(l[op])
+                    for kind, count in e[op].items():
+                        totals[op]['errors'][kind] = totals[op]['errors'].get(kind, 0) + count
+                        errors += count
+            r = summarize(latencies, now - last, errors)
+            sample = {'time' : now - start, 'throughput' : r['throughput'], 'p50' : r['p50'], 'p99' : r['p99'], 'errors' : errors,
+                      'rss' : rss(), 'traced' : tracemalloc.get_traced_memory()[0] if args.tracemalloc else None}
+            samples.append(sample)
+            ms = lambda v : 1000.0 * v if v is not None else float('nan')
+            mb = lambda v : v / 1048576.0 if v is not None else float('nan')
+            print('%8.1f %10.1f %10.3f %10.3f %8d %10.1f %10.1f' % (sample['time'], sample['throughput'] or 0.0, ms(sample['p50']), ms(sample['p99']), errors, mb(sample['rss']), mb(sample['traced'])))
+            last = now
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    for client in clients:
+        client.join()
+    for client in clients:
+        l, e, p = client.collect()
+        problems.extend(p)
+        for op in OPERATIONS:
+            totals[op]['latencies'].extend(l[op])
+            for kind, count in e[op].items():
+                totals[op]['errors'][kind] = totals[op]['errors'].get(kind, 0) + count
+    elapsed = time.perf_counter() - start
+
+    results = {}
+    print('\n%-16s %8s %10s %10s %10s %10s %s' % ('operation', 'calls', 'ops/s', 'p50 [ms]', 'p99 [ms]', 'max [ms]', 'errors'))
+    for op in OPERATIONS:
+        r = summarize(totals[op]['latencies'], elapsed, sum(totals[op]['errors'].values()))
+        r['error_types'] = totals[op]['errors']
+        results[op] = r
+        ms = lambda v : 1000.0 * v if v is not None else float('nan')
+        print('%-16s %8d %10.1f %10.3f %10.3f %10.3f %r' % (op, r['calls'], r['throughput'] or 0.0, ms(r['p50']), ms(r['p99']), ms(r['max']), r['error_types']))
+
+    memory = {}
+    if len(samples) > 1 and samples[0]['rss'] is not None:
+        memory['rss_growth'] = samples[-1]['rss'] - samples[0]['rss']
+        print('\nRSS growth after the first interval: %.2f MB' % (memory['rss_growth'] / 1048576.0))
+    if args.tracemalloc:
+        memory['traced_peak'] = tracemalloc.get_traced_memory()[1]
+        memory['top_growth'] = [str(stat) for stat in tracemalloc.take_snapshot().compare_to(baseline, 'lineno')[:10]]
+        print('Largest allocation growth:')
+        for line in memory['top_growth']:
+            print('   %s' % line)
+
+    # Private Fiducials objects don't see the commands of the other clients
+    fiducials = [shared] if shared else [client.fiducials for client in clients]
+    mismatched = verify(shared) if shared else None
+    print('\nStatus consistency problems: %d, commanded/actual mismatches: %s' % (len(problems), mismatched))
+    for problem in problems[:10]:
+        print('   %s' % problem)
+
+    for f in fiducials:
+        f.close()
+    for stop_standin in standins:
+        stop_standin()
+
+    if args.output:
+        meta = {'revision' : git_revision(),
+                'date' : datetime.datetime.utcnow().isoformat(),
+                'python' : platform.python_version(),
+                'host' : platform.node(),
+                'arguments' : vars(args)}
+        with open(args.output, 'w') as f:
+            json.dump({'meta' : meta, 'results' : results, 'samples' : samples, 'memory' : memory,
+                       'problems' : problems[:100], 'mismatched' : mismatched, 'perf_stats' : perf_stats.snapshot()}, f, indent=2)
+        print('Results written to %s' % args.output)
+    sys.exit()
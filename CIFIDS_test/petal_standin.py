@@ -0,0 +1,259 @@
+"""
+   Local stand-in for the PetalControl application
+   Serves get_fid_status, set_fiducials and get_posfid_info over Pyro4 so that FiposLED/FiposComm
+   can be exercised without hardware. Every call has a configurable latency distribution,
+   a drop rate (the call hangs for drop_delay seconds so that the client times out) and
+   per CanID failure probabilities.
+
+   The stand-in also serves the compact session protocol:
+      open_fid_session(canbus, can_ids)             registers the layout, returns a session id
+      set_fid_packed(session, duty, indices)        duty: little endian float64 bytes in layout order,
+                                                    indices: little endian int32 layout positions (None: all)
+      get_fid_status_packed(session)                duty bytes in layout order (-1: no response)
+   Packed vectors are bytes, use the serpent, marshal or pickle serializer.
+
+   Connect FiposLED using the controller option: device_options['controller'] = {'ip' : host, 'port' : port}
+
+   Example:
+   python petal_standin.py --device PC61 --port 50628 --canids 4840-4859,4870-4873 --latency uniform:0.005,0.02
+
+   Latency specifications:
+      0.01                  constant (seconds)
+      const:0.01            constant
+      uniform:a,b           uniform between a and b
+      normal:mu,sigma       normal distribution (clipped at 0)
+      lognormal:median,s    log-normal distribution with the given median and shape
+      exp:mean              exponential distribution
+"""
+import time, sys
+import math
+import random
+import threading
+import uuid
+import struct
+import argparse
+import Pyro4
+import serpent
+
+def make_latency(spec):
+    """
+    Returns a function that draws a latency (in seconds) from the distribution given by spec
+    """
+    if spec is None:
+        return lambda : 0.0
+    if isinstance(spec, (int, float)):
+        return lambda : float(spec)
+    kind, _, values = str(spec).partition(':')
+    if not values:
+        value = float(kind)
+        return lambda : value
+    p = [float(v) for v in values.split(',')]
+    kind = kind.lower()
+    if kind == 'const':
+        return lambda : p[0]
+    elif kind == 'uniform':
+        return lambda : random.uniform(p[0], p[1])
+    elif kind == 'normal':
+        return lambda : max(0.0, random.gauss(p[0], p[1]))
+    elif kind == 'lognormal':
+        return lambda : random.lognormvariate(math.log(p[0]), p[1])
+    elif kind == 'exp':
+        return lambda : random.expovariate(1.0 / p[0])
+    raise ValueError('Invalid latency specification %r' % spec)
+
+def parse_canids(text):
+    """
+    Convert '4840-4859,4870' to a list of CanIDs
+    """
+    ids = []
+    for part in str(text).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            ids.extend(range(int(first), int(last) + 1))
+        else:
+            ids.append(int(part))
+    return ids
+
+def unpack(data, code):
+    """
+    Unpack a little endian vector of struct type code (serpent transfers bytes as a dictionary)
+    """
+    if isinstance(data, dict):
+        data = serpent.tobytes(data)
+    data = bytes(data)
+    return struct.unpack('<%d%s' % (len(data) // struct.calcsize(code), code), data)
+
+@Pyro4.expose
+@Pyro4.behavior(instance_mode='single')
+class PetalControlStandIn(object):
+    """
+    Pyro object with the fiducial interface of PetalControl
+        can_ids     CanIDs of the fiducials on the petal
+        latency     latency specification for all calls, or a dictionary {command : specification}
+                    ('default' is used for commands not listed)
+        drop_rate   probability that a call hangs for drop_delay seconds
+        fail_ids    dictionary {CanID : probability} of a fiducial not responding
+    """
+    def __init__(self, can_ids, latency = None, drop_rate = 0.0, drop_delay = 60.0, fail_ids = {}):
+        self.can_ids = list(can_ids)
+        self.duty = {id : 0.0 for id in self.can_ids}
+        self.drop_rate = float(drop_rate)
+        self.drop_delay = float(drop_delay)
+        self.fail_ids = {int(id) : float(p) for id, p in fail_ids.items()}
+        if not isinstance(latency, dict):
+            latency = {'default' : latency}
+        self.latency = {cmd : make_latency(spec) for cmd, spec in latency.items()}
+        self.latency.setdefault('default', make_latency(None))
+        self.calls = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def _delay(self, cmd):
+        with self.lock:
+            self.calls[cmd] = self.calls.get(cmd, 0) + 1
+        if self.drop_rate > 0.0 and random.random() < self.drop_rate:
+            time.sleep(self.drop_delay)
+        delay = self.latency.get(cmd, self.latency['default'])()
+        if delay > 0.0:
+            time.sleep(delay)
+
+    def _fails(self, id):
+        return id in self.fail_ids and random.random() < self.fail_ids[id]
+
+    def get_fid_status(self):
+        self._delay('get_fid_status')
+        with self.lock:
+            return {str(id) : (-1 if self._fails(id) else self.duty[id]) for id in self.can_ids}
+
+    def set_fiducials(self, canbus, can_ids, duty):
+        self._delay('set_fiducials')
+        if len(canbus) != len(can_ids) or len(can_ids) != len(duty):
+            return 'FAILED: inconsistent argument lengths'
+        failed = []
+        with self.lock:
+            for id, value in zip(can_ids, duty):
+                id = int(id)
+                if id not in self.duty or self._fails(id):
+                    failed.append(id)
+                    continue
+                self.duty[id] = float(value)
+        if failed:
+            return 'FAILED: no response from CanIDs %r' % failed
+        return 'SUCCESS'
+
+    def open_fid_session(self, canbus, can_ids):
+        self._delay('open_fid_session')
+        if len(canbus) != len(can_ids):
+            raise ValueError('inconsistent argument lengths')
+        with self.lock:
+            session = uuid.uuid4().hex
+            self.sessions[session] = [int(id) for id in can_ids]
+        return session
+
+    def _layout(self, session):
+        with self.lock:
+            if session not in self.sessions:
+                raise KeyError('unknown session %r' % session)
+            return self.sessions[session]
+
+    def set_fid_packed(self, session, duty, indices = None):
+        self._delay('set_fid_packed')
+        layout = self._layout(session)
+        duty = unpack(duty, 'd')
+        positions = range(len(layout)) if indices is None else unpack(indices, 'i')
+        if len(duty) != len(positions):
+            return 'FAILED: inconsistent argument lengths'
+        failed = []
+        with self.lock:
+            for i, value in zip(positions, duty):
+                id = layout[i]
+                if id not in self.duty or self._fails(id):
+                    failed.append(id)
+                    continue
+                self.duty[id] = float(value)
+        if failed:
+            return 'FAILED: no response from CanIDs %r' % failed
+        return 'SUCCESS'
+
+    def get_fid_status_packed(self, session):
+        self._delay('get_fid_status_packed')
+        layout = self._layout(session)
+        with self.lock:
+            values = [-1.0 if id not in self.duty or self._fails(id) else self.duty[id] for id in layout]
+        return struct.pack('<%dd' % len(values), *values)
+
+    def get_posfid_info(self, canbus):
+        self._delay('get_posfid_info')
+        buses = sorted(set(canbus)) if isinstance(canbus, (list, tuple)) else [canbus]
+        info = {}
+        for bus in buses:
+            info[bus] = {str(id) : {'sid' : '%08x' % id, 'fw' : '5.0'} for id in self.can_ids if not self._fails(id)}
+        return info
+
+    def get_standin_stats(self, reset = False):
+        """
+        Returns the number of calls per command
+        """
+        with self.lock:
+            calls = dict(self.calls)
+            if reset:
+                self.calls = {}
+        return calls
+
+def start_standin(device = 'PC61', host = 'localhost', port = 0, serializers = None, **options):
+    """
+    Start a stand-in in a background thread
+    serializers is the list of accepted Pyro serializers (None: Pyro default; applies to the whole process)
+    options are passed to PetalControlStandIn
+    Returns (daemon, controller) where controller is the dictionary to use as the FiposLED controller option
+    """
+    if serializers:
+        Pyro4.config.SERIALIZERS_ACCEPTED = set(serializers)
+    standin = PetalControlStandIn(**options)
+    daemon = Pyro4.Daemon(host = host, port = int(port))
+    uri = daemon.register(standin, objectId = device)
+    thread = threading.Thread(target=daemon.requestLoop)
+    thread.setDaemon(True)
+    thread.start()
+    return daemon, {'ip' : uri.host, 'port' : str(uri.port)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Local stand-in for the PetalControl fiducial interface')
+    parser.add_argument('--device', default = 'PC61', help = 'Pyro object name (DOS device name)')
+    parser.add_argument('--host', default = 'localhost')
+    parser.add_argument('--port', type = int, default = 0)
+    parser.add_argument('--canids', default = '4840-4859,4870-4873', help = 'CanIDs, e.g. 4840-4859,4870')
+    parser.add_argument('--latency', default = None, help = 'latency for all calls, e.g. uniform:0.005,0.02')
+    parser.add_argument('--status_latency', default = None, help = 'latency for get_fid_status')
+    parser.add_argument('--set_latency', default = None, help = 'latency for set_fiducials')
+    parser.add_argument('--drop_rate', type = float, default = 0.0)
+    parser.add_argument('--drop_delay', type = float, default = 60.0)
+    parser.add_argument('--fail', action = 'append', default = [], help = 'CanID:probability, can be repeated')
+    parser.add_argument('--serializers', default = None, help = 'accepted Pyro serializers, e.g. serpent,marshal,pickle')
+    args = parser.parse_args()
+
+    latency = {'default' : args.latency}
+    if args.status_latency is not None:
+        latency['get_fid_status'] = args.status_latency
+    if args.set_latency is not None:
+        latency['set_fiducials'] = args.set_latency
+    fail_ids = {}
+    for item in args.fail:
+        id, _, p = item.partition(':')
+        fail_ids[int(id)] = float(p) if p else 1.0
+
+    serializers = args.serializers.split(',') if args.serializers else None
+    daemon, controller = start_standin(args.device, args.host, args.port, serializers = serializers, can_ids = parse_canids(args.canids),
+                                       latency = latency, drop_rate = args.drop_rate, drop_delay = args.drop_delay,
+                                       fail_ids = fail_ids)
+    print('PetalControl stand-in %s running at %s:%s' % (args.device, controller['ip'], controller['port']))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    daemon.shutdown()
+    sys.exit()
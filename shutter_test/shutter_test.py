@@ -1,69 +1,342 @@
 import time
 import Pyro4
 import threading
-from queue import Queue
+from queue import Queue, Empty
 import sys
-def shutter(spi, spiQueue):
-       t_previous = None
-       t_next = None
+import os
+import math
+import csv
+import json
+import argparse
+import itertools
+import random
+
+class TimingRecorder(object):
+	"""
+	Records the timing of every shutter command
+	Times are seconds on the monotonic high resolution clock (time.perf_counter) relative to the
+	start of the test. concurrency is the number of shutter commands in flight (including this one)
+	when the command started. queue_depth is the number of commands waiting in the queue of the
+	spectrograph when the command was taken, coalesced the number of queued commands it replaced.
+	"""
+	fields = ['spectrograph', 'command', 'enqueued', 'started', 'completed', 'queue_wait', 'duration', 'concurrency', 'queue_depth', 'coalesced', 'error']
+
+	def __init__(self):
+		self.t0 = time.perf_counter()
+		self.records = []
+		self.skipped = {}
+		self.in_flight = 0
+		self.lock = threading.Lock()
+
+	def now(self):
+		return time.perf_counter() - self.t0
+
+	def begin(self, spectrograph, command, enqueued, queue_depth = 1, coalesced = 0):
+		with self.lock:
+			self.in_flight += 1
+			return {'spectrograph' : spectrograph, 'command' : command, 'enqueued' : enqueued,
+				'started' : self.now(), 'concurrency' : self.in_flight, 'queue_depth' : queue_depth, 'coalesced' : coalesced}
+
+	def skip(self, spectrograph, count):
+		"""
+		count queued commands were dropped because the shutter already is in the target state
+		"""
+		with self.lock:
+			self.skipped[spectrograph] = self.skipped.get(spectrograph, 0) + count
+
+	def end(self, record, error = None):
+		record['completed'] = self.now()
+		record['queue_wait'] = record['started'] - record['enqueued']
+		record['duration'] = record['completed'] - record['started']
+		record['error'] = error
+		with self.lock:
+			self.in_flight -= 1
+			self.records.append(record)
+		return record
+
+	def write(self, filename):
+		"""
+		Write the records as CSV or, for .ndjson/.jsonl files, as newline delimited JSON
+		"""
+		with self.lock:
+			records = sorted(self.records, key = lambda r : r['started'])
+		if os.path.splitext(filename)[1].lower() in ['.ndjson', '.jsonl', '.json']:
+			with open(filename, 'w') as f:
+				for r in records:
+					f.write(json.dumps(r) + '\n')
+		else:
+			with open(filename, 'w', newline = '') as f:
+				writer = csv.DictWriter(f, fieldnames = self.fields)
+				writer.writeheader()
+				writer.writerows(records)
+
+	def summary(self):
+		"""
+		Duration statistics per spectrograph/command and per concurrency level
+		"""
+		with self.lock:
+			records = [r for r in self.records if r['error'] is None]
+		groups = {}
+		for r in records:
+			groups.setdefault(('%s %s' % (r['spectrograph'], r['command'])), []).append(r['duration'])
+			groups.setdefault(('concurrency %d' % r['concurrency']), []).append(r['duration'])
+		return {name : stats(values) for name, values in sorted(groups.items())}
+
+	def print_summary(self):
+		errors = len([r for r in self.records if r['error'] is not None])
+		print('%-24s %5s %10s %10s %10s %10s' % ('', 'n', 'mean [s]', 'p50 [s]', 'p95 [s]', 'max [s]'))
+		for name, s in self.summary().items():
+			print('%-24s %5d %10.4f %10.4f %10.4f %10.4f' % (name, s['n'], s['mean'], s['p50'], s['p95'], s['max']))
+		print('%d commands, %d errors' % (len(self.records), errors))
+		for name in sorted(set([r['spectrograph'] for r in self.records]) | set(self.skipped)):
+			records = [r for r in self.records if r['spectrograph'] == name]
+			print('%-12s max queue depth %d, %d commands coalesced, %d skipped' % (name, max([r['queue_depth'] for r in records] + [0]),
+											sum([r['coalesced'] for r in records]), self.skipped.get(name, 0)))
+
+def stats(values):
+	values = sorted(values)
+	pct = lambda p : values[max(0, min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1))]
+	return {'n' : len(values), 'mean' : sum(values) / len(values), 'p50' : pct(50), 'p95' : pct(95), 'max' : values[-1]}
+
+def shutter(name, spi, spiQueue, recorder, coalesce = False):
+	"""
+	Worker thread for one spectrograph
+	With coalesce = True all queued commands are collapsed into the latest one, which is skipped
+	if the shutter already is in that state.
+	"""
+	state = None
 	while(1):
-		cmd = spiQueue.get(True)
-		spi.nir_shutter(cmd)
-                t_previous = t_next
-                t_next = time.clock()
-                if t_previous is not None;
-                     delta_t = t_next - t_previous
-                     print(delta_t, "seconds wall time")
+		items = [spiQueue.get(True)]
+		depth = spiQueue.qsize() + 1
+		if coalesce:
+			while True:
+				try:
+					items.append(spiQueue.get_nowait())
+				except Empty:
+					break
+		cmd, enqueued = items[-1]
+		if coalesce and cmd == state:
+			recorder.skip(name, len(items))
+		else:
+			record = recorder.begin(name, cmd, enqueued, queue_depth = depth, coalesced = len(items) - 1)
+			try:
+				spi.nir_shutter(cmd)
+			except Exception as e:
+				recorder.end(record, error = str(e))
+				state = None
+				print(name, cmd, 'failed:', str(e))
+			else:
+				recorder.end(record)
+				state = cmd
+				print(name, cmd, '%.4f seconds (waited %.4f, %d in flight)' % (record['duration'], record['queue_wait'], record['concurrency']))
+		for item in items:
+			spiQueue.task_done()
 
-if __name__ == "__main__":
-	uri5="PYRO:SPECTCON8@140.254.79.216:38916"
-	sp5 = Pyro4.Proxy(uri5)
-	uri6="PYRO:SPECTCON9@140.254.78.255:35198"
-	sp6 = Pyro4.Proxy(uri6)
-	uri7="PYRO:SPECTCON10@140.254.79.214:35969" 
-	sp7 = Pyro4.Proxy(uri7)
-	input('before configure:')
-	sp5.configure()
-	sp6.configure()
-	sp7.configure()
-	input('after configure:')
-	
-	
-	SP = [sp5,sp6,sp7]
-	sp5_queue = Queue()
-	sp6_queue = Queue()
-	sp7_queue = Queue()
-	sp_queue = [sp5_queue,sp6_queue,sp7_queue]
-	for spi in SP: 
-        	mi=spi.get('mechanism')
-        	if mi['nir_shutter_power'] == 'ON':
-                	pass
-        	else:
-                	spi.power(device = 'nir_shutter',action='on')
-
-        	if mi['nir_shutter_seal'] == 'DEFLATED':
-                	pass
-        	else:
-                	spi.seal(shutter='nir_shutter',action='deflate')
-
-	for i in range(3):
-		t = threading.Thread(target=shutter, args=(SP[i],sp_queue[i],))
-		t.setDaemon(True)
-		t.start()		
-	print('test')	
+def device_name(uri):
+	"""
+	PYRO:SPECTCON8@140.254.79.216:38916 -> SPECTCON8
+	"""
+	return uri.split(':', 1)[-1].split('@')[0]
+
+def read_orders(filename, n):
+	"""
+	Read a work order file. Each line lists spectrograph indices in command order, optionally
+	followed by ':' and the delays (ms) between consecutive commands, e.g. '2 0 1 : 400 150'
+	"""
+	orders = []
+	with open(filename) as f:
+		for line in f:
+			line = line.split('#')[0].strip()
+			if not line:
+				continue
+			indices, _, delays = line.partition(':')
+			order = [int(x) for x in indices.split()]
+			if any(i < 0 or i >= n for i in order):
+				raise ValueError('work order %r refers to an unknown spectrograph' % line)
+			orders.append((order, [float(x) / 1000.0 for x in delays.split()]))
+	return orders
+
+def all_orders(n, limit = None):
+	"""
+	Every permutation of the n spectrographs (a random sample of limit permutations if given)
+	"""
+	orders = [(list(p), []) for p in itertools.permutations(range(n))] if limit is None or math.factorial(n) <= limit else None
+	if orders is None:
+		orders = []
+		for i in range(limit):
+			order = list(range(n))
+			random.shuffle(order)
+			orders.append((order, []))
+	return orders
+
+def bring_up(name, spi, timeout, cancel = None):
+	"""
+	configure the spectrograph, power on the NIR shutter and deflate the seal
+	All steps share one deadline timeout seconds after the start. No step is started after
+	the deadline or once cancel is set.
+	Returns a readiness report with the duration of every step
+	"""
+	report = {'spectrograph' : name, 'ready' : False, 'error' : None}
+	start = time.perf_counter()
+	deadline = start + timeout
+	def next_step(step):
+		if cancel is not None and cancel.is_set():
+			raise RuntimeError('cancelled before %s' % step)
+		remaining = deadline - time.perf_counter()
+		if remaining <= 0:
+			raise RuntimeError('timeout after %.1f seconds before %s' % (timeout, step))
+		spi._pyroTimeout = remaining
+		return time.perf_counter()
+	try:
+		step = next_step('configure')
+		spi.configure()
+		report['configure'] = time.perf_counter() - step
+		step = next_step('mechanism')
+		mi=spi.get('mechanism')
+		report['mechanism'] = time.perf_counter() - step
+		step = next_step('power')
+		if mi['nir_shutter_power'] == 'ON':
+			pass
+		else:
+			spi.power(device = 'nir_shutter',action='on')
+		report['power'] = time.perf_counter() - step
+		step = next_step('seal')
+		if mi['nir_shutter_seal'] == 'DEFLATED':
+			pass
+		else:
+			spi.seal(shutter='nir_shutter',action='deflate')
+		report['seal'] = time.perf_counter() - step
+		report['ready'] = True
+	except Exception as e:
+		report['error'] = str(e)
+	finally:
+		spi._pyroTimeout = None
+	report['elapsed'] = time.perf_counter() - start
+	return report
+
+def bring_up_all(names, SP, timeout):
+	"""
+	Bring up all spectrographs concurrently. Returns the readiness reports (in the order of SP)
+	"""
+	start = time.perf_counter()
+	reports = [None for i in range(len(SP))]
+	cancel = threading.Event()
+	def run(i):
+		reports[i] = bring_up(names[i], SP[i], timeout, cancel)
+	threads = [threading.Thread(target = run, args = (i,)) for i in range(len(SP))]
+	for thread in threads:
+		thread.daemon = True     # don't block the exit on a hanging spectrograph
+		thread.start()
+	# Every bring-up ends by its deadline, allow one second for the last reply
+	for thread in threads:
+		thread.join(max(0.0, start + timeout + 1.0 - time.perf_counter()))
+	cancel.set()
+	for i in range(len(SP)):
+		if reports[i] is None:
+			reports[i] = {'spectrograph' : names[i], 'ready' : False, 'error' : 'timeout after %.1f seconds' % timeout, 'elapsed' : time.perf_counter() - start}
+	ms = lambda r, step : '%8.1f' % (1000.0 * r[step]) if step in r else '%8s' % '-'
+	print('%-12s %6s %8s %8s %8s %8s %8s  %s' % ('', 'ready', 'config', 'mech', 'power', 'seal', 'total', '[ms]'))
+	for r in reports:
+		print('%-12s %6s %s %s %s %s %8.1f  %s' % (r['spectrograph'], r['ready'], ms(r, 'configure'), ms(r, 'mechanism'), ms(r, 'power'), ms(r, 'seal'),
+							  1000.0 * r['elapsed'], r['error'] or ''))
+	print('bring-up: %d of %d spectrographs ready after %.3f seconds' % (len([r for r in reports if r['ready']]), len(reports), time.perf_counter() - start))
+	return reports
+
+def send(sp_queue, order, delays, cmd, recorder):
+	for k, i in enumerate(order):
+		if k > 0 and k - 1 < len(delays) and delays[k - 1] > 0:
+			time.sleep(delays[k - 1])
+		if sp_queue[i] is None:      # spectrograph not ready
+			continue
+		sp_queue[i].put((cmd, recorder.now()))
+
+def wait_idle(sp_queue):
+	for q in sp_queue:
+		if q is not None:
+			q.join()
+
+def run_batch(sp_queue, orders, cycles, open_time, close_time, recorder):
+	"""
+	Run every work order cycles times without operator interaction
+	"""
+	total = cycles * len(orders)
+	count = 0
+	for cycle in range(cycles):
+		for order, delays in orders:
+			count += 1
+			print('cycle %d/%d: order %s' % (count, total, ' '.join([str(i) for i in order])))
+			send(sp_queue, order, delays, 'open', recorder)
+			wait_idle(sp_queue)
+			time.sleep(open_time)
+			send(sp_queue, order, delays, 'close', recorder)
+			wait_idle(sp_queue)
+			time.sleep(close_time)
+
+def run_interactive(sp_queue, recorder):
 	value = input('Continue? Y/N\n')
 	print(value)
 	while value != 'N':
 		value = input('work order: e.g: 0 1 2\n')
 		work_ord = [int(x) for x in value.split()]
-		sp_queue[work_ord[0]].put('open')
-		sp_queue[work_ord[1]].put('open')
-		sp_queue[work_ord[2]].put('open')
+		send(sp_queue, work_ord, [], 'open', recorder)
 		time.sleep(5)
 		value = input('Continue closing? Y/N\n')
-		sp_queue[work_ord[0]].put('close')
-		sp_queue[work_ord[1]].put('close')
-		sp_queue[work_ord[2]].put('close')
+		send(sp_queue, work_ord, [], 'close', recorder)
 		value = input('Continue? Y/N\n')
-		
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = 'NIR shutter timing test')
+	parser.add_argument('--uris', default = 'PYRO:SPECTCON8@140.254.79.216:38916,PYRO:SPECTCON9@140.254.78.255:35198,PYRO:SPECTCON10@140.254.79.214:35969',
+			    help = 'comma separated Pyro URIs of the spectrographs')
+	parser.add_argument('--batch', action = 'store_true', help = 'run unattended (requires --orders or --permutations)')
+	parser.add_argument('--orders', default = None, help = 'work order file')
+	parser.add_argument('--permutations', action = 'store_true', help = 'use every permutation of the spectrographs as work orders')
+	parser.add_argument('--max_orders', type = int, default = 720, help = 'random sample size if there are more permutations')
+	parser.add_argument('--cycles', type = int, default = 1, help = 'number of passes over the work orders')
+	parser.add_argument('--open_time', type = float, default = 5.0, help = 'seconds the shutters stay open')
+	parser.add_argument('--close_time', type = float, default = 1.0, help = 'seconds between cycles')
+	parser.add_argument('--coalesce', action = 'store_true', help = 'collapse queued commands into the latest target state')
+	parser.add_argument('--timeout', type = float, default = 60.0, help = 'deadline for the whole bring-up of each spectrograph (seconds)')
+	parser.add_argument('--output', default = None, help = 'timing records (.csv or .ndjson)')
+	args = parser.parse_args()
+
+	uris = [u.strip() for u in args.uris.split(',') if u.strip()]
+	names = [device_name(u) for u in uris]
+	SP = [Pyro4.Proxy(u) for u in uris]
+	if args.batch:
+		if args.orders:
+			orders = read_orders(args.orders, len(SP))
+		elif args.permutations:
+			orders = all_orders(len(SP), args.max_orders)
+		else:
+			parser.error('--batch requires --orders or --permutations')
+
+	if not args.batch:
+		input('before configure:')
+	reports = bring_up_all(names, SP, args.timeout)
+	if not any(r['ready'] for r in reports):
+		print('No spectrograph ready')
+		sys.exit(1)
+	if not args.batch:
+		input('after configure:')
+
+	sp_queue = [Queue() if r['ready'] else None for r in reports]
+	recorder = TimingRecorder()
+	for i in range(len(SP)):
+		if sp_queue[i] is None:
+			continue
+		t = threading.Thread(target=shutter, args=(names[i],SP[i],sp_queue[i],recorder,args.coalesce,))
+		t.setDaemon(True)
+		t.start()
+	print('test')
+	if args.batch:
+		run_batch(sp_queue, orders, args.cycles, args.open_time, args.close_time, recorder)
+	else:
+		run_interactive(sp_queue, recorder)
+
+	wait_idle(sp_queue)
+	recorder.print_summary()
+	if args.output:
+		recorder.write(args.output)
+		print('Timing records written to %s' % args.output)
 	sys.exit()